@@ -1,37 +1,56 @@
 from shared_utils.models import WorkItemUpdate, BacklogItem
 from shared_utils.context import Context
-from typing import List
-from shared_utils.nlp import generate_completion, generate_chat_completion
+from typing import Callable, List, Tuple
+from weakref import WeakValueDictionary
+from shared_utils.nlp import agenerate_chat_completion
+from shared_utils.prompts import assemble_prompt
 from shared_utils.configurations import Configurations
+from shared_utils.service_client import service_get, service_post, close_client
+from shared_utils.streaming import Emit, respond
 import logging
 from shared_utils.logging_config import setup_logging
-import requests
+import asyncio
+import httpx
 import json
+import os
 import uvicorn
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 
 app = FastAPI()
+install_metrics(app, 'developer')
+install_tracing(app, 'developer')
 context = Context()
 configurations = Configurations()
 logger = logging.getLogger(__name__)
 
-# code base address
-host = configurations.get('microservices', 'code_base', 'hostname')
-port = configurations.get('microservices', 'code_base', 'port')
-code_base_address = f"http://{host}:{port}"
-
 tasks_per_backlog_item = configurations.get('program_management', 'tasks_per_backlog_item')
-
-
-async def get_detailed_tasks(item: BacklogItem, vision: dict, structure: dict, files_data: List[dict]) -> List[str]:
-    files_structure = 'id,file path,file name,purpose\n'
-    for i, file_data in enumerate(files_data):
-        files_structure += '{},{},{},{}\n'.format(i,
-                                                  file_data['path'],
-                                                  file_data['name'],
-                                                  file_data['purpose'])
-
-    planning_prompt = f"""The customer described the project as {vision['description']}.
+# Detailed tasks of one backlog item worked on at the same time
+parallel_tasks_per_item = configurations.get('program_management', 'parallel_tasks_per_item', default=5)
+code_search_wait_ms = configurations.get('program_management', 'code_search_wait_ms', default=100)
+repo_path = configurations.get('git', 'repo_path')
+
+# One lock per file in the repo, held from reading a file until its new content is written
+_file_locks = WeakValueDictionary()
+
+
+def file_lock(file_path: str) -> asyncio.Lock:
+    key = os.path.normpath(os.path.join(repo_path, file_path))
+    lock = _file_locks.get(key)
+    if lock is None:
+        lock = _file_locks[key] = asyncio.Lock()
+    return lock
+
+
+async def get_detailed_tasks(item: BacklogItem, vision: dict, structure: dict, files_data: List[dict],
+                             on_task: Callable[[str], None] = None) -> List[str]:
+    """
+    Plans the detailed tasks of a backlog item.  The plan is streamed, on_task is called with
+    each task as soon as its line has arrived.
+    """
+    def build(files_structure: str) -> str:
+        return f"""The customer described the project as {vision['description']}.
     Your teams software architect setup the project structure using a {structure['architecture_paradigm']} 
     architecture paradigm.  The project structure is:\n
     {files_structure}
@@ -40,6 +59,9 @@ async def get_detailed_tasks(item: BacklogItem, vision: dict, structure: dict, f
     this task. Your team members should be able to develop code from each item in your list. 
     Do not number the list or provide additional explanation."""
 
+    # Only the files relevant to the backlog item are listed once the project outgrows the token budget
+    planning_prompt = await assemble_prompt(build, structure, item.item['description'])
+
     messages = [
         {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
                                       "development team."},
@@ -47,26 +69,77 @@ async def get_detailed_tasks(item: BacklogItem, vision: dict, structure: dict, f
     ]
 
     logger.debug(planning_prompt)
-    detailed_tasks = generate_chat_completion(messages, max_tokens=2000).split('\n')
+    def on_line(line: str) -> None:
+        if line.strip() and on_task is not None:
+            on_task(line)
+
+    plan = await agenerate_chat_completion(messages, max_tokens=2000, call_site='get_detailed_tasks',
+                                           on_line=on_line)
+    detailed_tasks = [line for line in plan.split('\n') if line.strip()]
     logger.debug(detailed_tasks)
 
     return detailed_tasks
 
 
-async def get_candidate_code(detailed_task: str, item: BacklogItem, files_data: List[dict]) -> str:
-    relevant_code_response = requests.get(code_base_address + '/search_code',
-                                          params={"query": detailed_task, "top_k": 5})
-    relevant_code_matches = relevant_code_response.json()['results']['matches']
+class CodeSearch:
+    """
+    Searches the code base for the detailed tasks of one backlog item.  A search waits
+    `wait_ms` for others to join it, and the queries made while a batch is in flight go out
+    together in the next /search_code_batch call.  Tasks planned further apart than the wait
+    are searched in separate calls, a longer wait saves calls but holds back every task.
+    """
+
+    def __init__(self, top_k: int = 5, wait_ms: float = 0):
+        self.top_k = top_k
+        self.wait = wait_ms / 1000
+        self._pending = []
+        self._sending = None
+
+    async def search(self, query: str) -> List[dict]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        if self._sending is None:
+            self._sending = asyncio.create_task(self._send())
+        return await future
+
+    async def _send(self) -> None:
+        batch = []
+        try:
+            while self._pending:
+                if self.wait > 0:
+                    await asyncio.sleep(self.wait)
+                batch, self._pending = self._pending, []
+                try:
+                    response = await service_post('code_base', '/search_code_batch',
+                                                  json={"queries": [query for query, _ in batch], "top_k": self.top_k})
+                    response.raise_for_status()
+                    results = response.json()['results']
+                    if len(results) != len(batch):
+                        raise ValueError(f'Expected {len(batch)} code search results, got {len(results)}')
+                    for (_, future), result in zip(batch, results):
+                        # Skips the searches whose caller was cancelled meanwhile
+                        if not future.done():
+                            future.set_result(result['matches'])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            self._sending = None
+            # Only left unresolved when this task was cancelled, no search may wait forever
+            for _, future in batch + self._pending:
+                if not future.done():
+                    future.cancel()
+
+
+async def get_candidate_code(detailed_task: str, item: BacklogItem, files_data: List[dict],
+                             code_search: CodeSearch) -> str:
+    relevant_code_matches = await code_search.search(detailed_task)
     if relevant_code_matches:
         logger.info(relevant_code_matches)
-        relevant_code = relevant_code_matches
         results = ['path:name,description']
-        for match_string in relevant_code:
-            match = eval(match_string)
-            fid = match['metadata']['id']
-            #file_path = match['metadata']['file_path']
-            desc = match['metadata']['description']
-            results.append(f'{fid},{desc}')
+        for match in relevant_code_matches:
+            results.append(f"{match['id']},{match['description']}")
 
         code_list = '\n'.join(results)
 
@@ -84,7 +157,7 @@ async def get_candidate_code(detailed_task: str, item: BacklogItem, files_data:
             {"role": "user", "content": code_context}
         ]
 
-        candidate_code = generate_chat_completion(messages, max_tokens=2000)
+        candidate_code = await agenerate_chat_completion(messages, max_tokens=2000, call_site='get_candidate_code')
 
     else:
         candidate_code = 'add a new function'
@@ -93,15 +166,9 @@ async def get_candidate_code(detailed_task: str, item: BacklogItem, files_data:
 
 
 async def handle_new_function(detailed_task: str, item: BacklogItem,
-                              vision: dict, structure: dict) -> requests.Response:
-    files_data = structure['files']
-    files_structure = 'id,file path,file name,purpose\n'
-    for i, file_data in enumerate(files_data):
-        files_structure += '{},{},{},{}\n'.format(i,
-                                                  file_data['path'],
-                                                  file_data['name'],
-                                                  file_data['purpose'])
-    new_function_prompt = f"""One of your team members is working on {item.item['description']}.  
+                              vision: dict, structure: dict) -> Tuple[str, httpx.Response]:
+    def build(files_structure: str) -> str:
+        return f"""One of your team members is working on {item.item['description']}.  
     They have asked your advice for where to implement {detailed_task}. The project structure is:\n
     {files_structure}\n
     Please respond to your colleague with either the file path of the relevant file 
@@ -112,44 +179,55 @@ async def handle_new_function(detailed_task: str, item: BacklogItem,
     update:<file path>\n
     Please don't include any additional explanation."""
 
+    new_function_prompt = await assemble_prompt(build, structure, detailed_task)
+
     messages = [
         {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
                                       "development team."},
         {"role": "user", "content": new_function_prompt}
     ]
 
-    candidate_file = generate_chat_completion(messages, max_tokens=2000)
+    candidate_file = await agenerate_chat_completion(messages, max_tokens=2000, call_site='get_candidate_file')
+
+    target_path = candidate_file.split(':')[1].strip(' ')
+    async with file_lock(target_path):
+        if 'new:' in candidate_file.lower():
+            response = await create_new_file(detailed_task, target_path, item, vision, structure)
+        else:
+            response = await update_file(detailed_task, target_path, item, structure)
+    return target_path, response
+
 
-    if 'new:' in candidate_file.lower():
-        target_path = candidate_file.split(':')[1].strip(' ')
-        work_prompt = f"""The customer described the project as {vision['description']}.\n
+async def create_new_file(detailed_task: str, target_path: str, item: BacklogItem,
+                          vision: dict, structure: dict) -> httpx.Response:
+    work_prompt = f"""The customer described the project as {vision['description']}.\n
             Your are working on the '{item.item['description']}' backlog item.  
             In order to accomplish the '{detailed_task}' detailed task you are adding 
             the new file, {target_path}, to the repo.  Your teams software architect setup the 
             project structure using a {structure['architecture_paradigm']} architecture paradigm.
             Please respond with the content of the new file and nothing else."""
 
-        messages = [
-            {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
-                                          "development team."},
-            {"role": "user", "content": work_prompt}
-        ]
+    messages = [
+        {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
+                                      "development team."},
+        {"role": "user", "content": work_prompt}
+    ]
 
-        completed_work = generate_chat_completion(messages, max_tokens=2049)
+    completed_work = await agenerate_chat_completion(messages, max_tokens=2049, call_site='create_new_file')
 
-        data = {
-            "file_path": target_path,
-            "content": completed_work
-        }
+    data = {
+        "file_path": target_path,
+        "content": completed_work
+    }
 
-        response = requests.post(code_base_address + '/create_file', json=data)
+    return await service_post('code_base', '/create_file', json=data)
 
-    else:
-        target_path = candidate_file.split(':')[1].strip(' ')
-        target_code = requests.get(code_base_address + '/get_code',
-                                   params={"file_path": target_path}).json()['content']
 
-        work_prompt = f"""Your are working on the '{item.item['description']}' backlog item.  
+async def update_file(detailed_task: str, target_path: str, item: BacklogItem, structure: dict) -> httpx.Response:
+    target_code = (await service_get('code_base', '/get_code',
+                                     params={"file_path": target_path})).json()['content']
+
+    work_prompt = f"""Your are working on the '{item.item['description']}' backlog item.  
             In order to accomplish the '{detailed_task}' detailed task you are adding 
             the new function, {target_path}, to the repo.  Your teams software architect setup the 
             project structure using a {structure['architecture_paradigm']} architecture paradigm.
@@ -157,29 +235,34 @@ async def handle_new_function(detailed_task: str, item: BacklogItem,
             Please do not provide any additional explanation.
             Code to update:\n{target_code}"""
 
-        messages = [
-            {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
-                                          "development team."},
-            {"role": "user", "content": work_prompt}
-        ]
+    messages = [
+        {"role": "system", "content": "You are an exceptionally talented software developer working on an agile "
+                                      "development team."},
+        {"role": "user", "content": work_prompt}
+    ]
 
-        completed_work = generate_chat_completion(messages, max_tokens=2049)
+    completed_work = await agenerate_chat_completion(messages, max_tokens=2049, call_site='update_file')
 
-        data = {
-            "file_path": target_path,
-            "content": completed_work
-        }
+    data = {
+        "file_path": target_path,
+        "content": completed_work
+    }
 
-        response = requests.post(code_base_address + '/update_code', json=data)
-    return response
+    return await service_post('code_base', '/update_code', json=data)
 
 
 async def handle_existing_function(detailed_task: str, candidate_code: str,
-                                   item: BacklogItem, structure: dict) -> requests.Response:
+                                   item: BacklogItem, structure: dict) -> Tuple[str, httpx.Response]:
     target_path = candidate_code.split(':')[0].strip(' ')
     target_function = candidate_code.split(':')[1].strip(' ')
-    target_code = requests.get(code_base_address + '/get_code',
-                               params={"file_path": target_path}).json()['content']
+    async with file_lock(target_path):
+        return target_path, await update_function(detailed_task, target_path, target_function, item, structure)
+
+
+async def update_function(detailed_task: str, target_path: str, target_function: str,
+                          item: BacklogItem, structure: dict) -> httpx.Response:
+    target_code = (await service_get('code_base', '/get_code',
+                                     params={"file_path": target_path})).json()['content']
 
     work_prompt = f"""You are working on the '{item.item['description']}' backlog item.  
         In order to accomplish the '{detailed_task}' detailed task you are updating 
@@ -195,32 +278,75 @@ async def handle_existing_function(detailed_task: str, candidate_code: str,
         {"role": "user", "content": work_prompt}
     ]
 
-    completed_work = generate_chat_completion(messages, max_tokens=2049)
+    completed_work = await agenerate_chat_completion(messages, max_tokens=2049, call_site='update_function')
 
     data = {
         "file_path": target_path,
         "content": completed_work
     }
 
-    response = requests.post(code_base_address + '/update_code', json=data)
+    return await service_post('code_base', '/update_code', json=data)
 
-    return response
 
+async def work_on_task(detailed_task: str, item: BacklogItem, vision: dict, structure: dict,
+                       files_data: List[dict], code_search: CodeSearch) -> Tuple[str, httpx.Response]:
+    """Works on one detailed task, returns the path of the file written and code_base's response."""
+    candidate_code = await get_candidate_code(detailed_task, item, files_data, code_search)
 
-@app.post("/work_on_item")
-async def work_on_item(item: BacklogItem):
-    vision = context.get_project_vision()
-    structure = context.get_project_structure()
+    if 'add a new function' in candidate_code.lower():
+        return await handle_new_function(detailed_task, item, vision, structure)
+    return await handle_existing_function(detailed_task, candidate_code, item, structure)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_client()
+
+
+async def develop_item(item: BacklogItem, emit: Emit) -> dict:
+    vision, structure = await context.aget_project_context()
     files_data = structure['files']
-    detailed_tasks = await get_detailed_tasks(item, vision, structure, files_data)
 
-    for detailed_task in detailed_tasks:
-        candidate_code = await get_candidate_code(detailed_task, item, files_data)
+    # The tasks run concurrently, edits of the same file are serialised by its file lock
+    semaphore = asyncio.Semaphore(parallel_tasks_per_item)
+    code_search = CodeSearch(wait_ms=code_search_wait_ms)
+    runs = []
+
+    async def run(detailed_task):
+        async with semaphore:
+            try:
+                file_path, response = await work_on_task(detailed_task, item, vision, structure, files_data,
+                                                          code_search)
+            except Exception as e:
+                logger.error(f'Detailed task failed: {detailed_task}: {e!r}')
+                emit({"event": "task_failed", "task": detailed_task, "message": repr(e)})
+                raise
+        result = {"task": detailed_task, "file_path": file_path, "status_code": response.status_code}
+        emit({"event": "task_completed", **result})
+        return result
+
+    def start(detailed_task):
+        emit({"event": "task_planned", "task": detailed_task})
+        runs.append(asyncio.create_task(run(detailed_task)))
+
+    # Work on each detailed task starts as soon as the plan has named it
+    try:
+        await get_detailed_tasks(item, vision, structure, files_data, on_task=start)
+        results = await asyncio.gather(*runs, return_exceptions=True)
+    finally:
+        # Stops the tasks still running when planning failed or the caller went away
+        for task in runs:
+            task.cancel()
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+    return {"success": True, "message": f"{len(results)} detailed tasks completed", "tasks": results}
 
-        if 'add a new function' in candidate_code.lower():
-            response = await handle_new_function(detailed_task, item, vision, structure)
-        else:
-            response = await handle_existing_function(detailed_task, candidate_code, item, structure)
+
+@app.post("/work_on_item")
+async def work_on_item(item: BacklogItem, stream: bool = False):
+    return await respond(lambda emit: develop_item(item, emit), stream)
 
 
 if __name__ == '__main__':
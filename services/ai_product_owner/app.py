@@ -1,25 +1,25 @@
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 from typing import List
 import logging
-import requests
 import json
 from shared_utils.logging_config import setup_logging
 from shared_utils.configurations import configurations
-from shared_utils.nlp import generate_chat_completion, generate_embedding, sanitize_ai_response
+from shared_utils.service_client import service_post, close_client
+from shared_utils.nlp import agenerate_chat_completion, StructuredOutputParser
 from shared_utils.models import ProductVision, BacklogItem
 import uvicorn
 
 app = FastAPI()
+install_metrics(app, 'product_owner')
+install_tracing(app, 'product_owner')
 logger = logging.getLogger(__name__)
 
-# backlog routes
-host = configurations.get('microservices', 'backlog', 'hostname')
-port = configurations.get('microservices', 'backlog', 'port')
-backlog_address = f"http://{host}:{port}"
 
-host = configurations.get('microservices', 'program_management', 'hostname')
-port = configurations.get('microservices', 'program_management', 'port')
-program_management_address = f"http://{host}:{port}"
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_client()
 
 
 @app.post("/receive_product_vision")
@@ -46,28 +46,32 @@ async def receive_product_vision(vision: ProductVision):
         {"role": "user", "content": prompt}
     ]
 
-    # Send the prompt to the get_completions function and get the response
-    completions = eval(generate_chat_completion(messages, model='gpt-4', max_tokens=1000))
+    # The list is parsed while the reply streams in, and repaired if the reply is cut off
+    parser = StructuredOutputParser(openers='[')
+    await agenerate_chat_completion(messages, model='gpt-4', max_tokens=1000, call_site='initial_backlog',
+                                    on_line=lambda line: parser.feed(line + '\n'))
+    parser.close()
+    if not parser.values:
+        raise ValueError('The initial backlog is not a list')
+    completions = [str(item) for item in parser.values[0]]
 
     logger.debug('Initial backlog items')
     logger.debug('\n'.join(completions))
 
-    # Invoke the backlog add item API to add each of the new items
-    for i, item in enumerate(completions):
-        new_item = BacklogItem(priority=i, item={'description': item})
-        data = json.dumps(new_item.__dict__)
-        response = requests.post(backlog_address + '/add_item',
-                                 data=data,
-                                 headers={'Content-Type': 'application/json'})
+    # Add the new items to the backlog in one request
+    new_items = [BacklogItem(priority=i, item={'description': item}) for i, item in enumerate(completions)]
+    response = await service_post('backlog', '/add_items',
+                                  content=json.dumps([new_item.__dict__ for new_item in new_items]),
+                                  headers={'Content-Type': 'application/json'})
 
-    response = requests.post(program_management_address + '/create_project',
-                             data=json.dumps(vision.__dict__),
-                             headers={'Content-Type': 'application/json'})
+    response = await service_post('program_management', '/create_project',
+                                  content=json.dumps(vision.__dict__),
+                                  headers={'Content-Type': 'application/json'})
 
     logger.debug('Starting sprint')
-    response = requests.post(program_management_address + '/start_sprint',
-                             data=json.dumps(vision.__dict__),
-                             headers={'Content-Type': 'application/json'})
+    response = await service_post('program_management', '/start_sprint',
+                                  content=json.dumps(vision.__dict__),
+                                  headers={'Content-Type': 'application/json'})
     # TODO update response with sprint review summary and return to the customer communication endpoint
     return {"success": True, "message": "Backlog items created"}
 
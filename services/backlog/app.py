@@ -1,20 +1,23 @@
 from fastapi import FastAPI, HTTPException
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 from pydantic import ValidationError
 from typing import List, Optional
 from shared_utils.models import BacklogItem
-from shared_utils.nlp import generate_embedding
+from shared_utils.nlp import agenerate_embedding, agenerate_embeddings
 from shared_utils.backlog import BacklogWithEmbedding
 from shared_utils.configurations import configurations
 import uvicorn
-import heapq
 import logging
 from shared_utils.logging_config import setup_logging
 
 backlog_namespace = configurations.get('pinecone', 'backlog_namespace')
 
 app = FastAPI()
+install_metrics(app, 'backlog')
+install_tracing(app, 'backlog')
 logger = logging.getLogger(__name__)
-backlog = BacklogWithEmbedding()
+backlog = BacklogWithEmbedding('product_backlog')
 
 
 @app.post("/add_item")
@@ -26,17 +29,26 @@ async def add_item(item: BacklogItem):
         return {"error": str(e)}
 
     logger.info(f'Add backlog item\n {item}')
-    embedding = generate_embedding(item.item['description'])
+    embedding = await agenerate_embedding(item.item['description'], call_site='add_item')
     backlog.add_item(item, embedding, backlog_namespace)
     return {"success": True, "message": "new item added"}
 
 
+@app.post("/add_items")
+async def add_items(items: List[BacklogItem]):
+    logger.info(f'Add {len(items)} backlog items')
+    if items:
+        embeddings = await agenerate_embeddings([item.item['description'] for item in items], call_site='add_items')
+        backlog.add_items(items, embeddings, backlog_namespace)
+    return {"success": True, "message": f"{len(items)} new items added"}
+
+
 @app.get("/get_top_items")
 async def get_top_items(number_of_items: Optional[int] = 5):
     if number_of_items < 1:
         raise HTTPException(status_code=400, detail="Number of items should be greater than 0")
 
-    top_items = heapq.nsmallest(number_of_items, backlog.get_backlog())
+    top_items = backlog.top_items(number_of_items)
     logger.debug(top_items)
     return {"backlog_items": [item.__dict__ for item in top_items]}
 
@@ -1,16 +1,31 @@
+import asyncio
+import contextvars
 import os
+import threading
 import git
+from typing import List
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing, span
 import logging
 from shared_utils.logging_config import setup_logging
-from shared_utils.models import CodeBaseFunction, ProjectFile
-from shared_utils.PineconeDatabase import PineconeDatabase
+from shared_utils.models import CodeBaseFunction, ProjectFile, CodeSearchMatch, CodeSearchResults, CodeSearchRequest, \
+    CodeSearchResponse, CodeSearchBatchResponse
+from shared_utils.vector_database import get_vector_database
+from shared_utils.vector_database_base import code_vector
 from shared_utils.configurations import configurations
-from shared_utils.nlp import generate_embedding, generate_completion
+from shared_utils.nlp import agenerate_embedding, agenerate_embeddings, generate_embeddings, generate_completion, \
+    CACHE_ALWAYS
+from services.code_base.index_manifest import IndexManifest, content_hash
+from services.code_base.extractor import extract_files
+from services.code_base.indexing_pipeline import IndexingPipeline, IndexProgress
+from shared_utils.rate_limit import RateLimiter
 import uvicorn
 
 
 app = FastAPI()
+install_metrics(app, 'code_base')
+install_tracing(app, 'code_base')
 logger = logging.getLogger(__name__)
 
 # Initialize the Git repository
@@ -24,85 +39,202 @@ else:
     # The repository doesn't exist, initialize it
     repo = git.Repo.init(repo_path)
 
-# Initialize the Pinecone vector database
-pinecone_api_key = configurations.get("pinecone", "api_key")
-vector_db = PineconeDatabase(pinecone_api_key)
 
+def run_git(command: str, *args, **kwargs):
+    """Runs a git command on the repository, recorded as a trace span."""
+    with span(f'git {command}', 'git'):
+        return getattr(repo.git, command)(*args, **kwargs)
 
-def get_function_name(code):
-    """
-    Extract function name from a line beginning with "def "
+
+# Initialize the vector database
+vector_db = get_vector_database()
+
+# Content hashes of what is already indexed, used to re-index incrementally
+manifest = IndexManifest(configurations.get("code_base", "manifest_path",
+                                            default="./sprintswarm/index/codebase_manifest.json"))
+
+# Processes used to parse files, None uses one per CPU
+extract_workers = configurations.get("code_base", "extract_workers")
+
+
+# Concurrency and provider rate limits of the indexing pipeline
+indexing_config = configurations.get("code_base", "indexing", default={})
+completion_limiter = RateLimiter(indexing_config.get("completion_requests_per_minute", 3000))
+embedding_limiter = RateLimiter(indexing_config.get("embedding_requests_per_minute", 3000))
+
+# Counters of the current or last indexing run
+index_progress = IndexProgress()
+index_lock = threading.Lock()
+indexing_task = None
+
+
+def summarize_function(item: dict) -> str:
+    function_name = item["definition"]["qualified_name"]
+    function_code = item["definition"]["code"]
+    logger.debug(f'indexing {function_name}')
+    summary_prompt = f"""
+    Please generate a brief 1 to 2 sentence description of the following function 
+    ({function_name}) without any additional explanation:\n
+    {function_code} 
     """
-    assert code.startswith("def ")
-    return code[len("def "): code.index("(")]
+    return generate_completion(summary_prompt, cache_policy=CACHE_ALWAYS, call_site='index_codebase_summary')[0]
+
+
+def embed_descriptions(descriptions: List[str]) -> List[List[float]]:
+    return generate_embeddings(descriptions, call_site='index_codebase_embedding')
+
 
+def upsert_functions(items: List[dict]) -> None:
+    code_vectors = []
+    for item in items:
+        definition = item["definition"]
+        code_base_function = CodeBaseFunction(
+            id=item["id"],
+            function_name=definition["qualified_name"],
+            file_path=item["file_path"],
+            code=definition["code"],
+            embedding=item["embedding"],
+            description=item["description"],
+            kind=definition["kind"],
+            start_line=definition["start_line"],
+            end_line=definition["end_line"]
+        )
+        code_vectors.append(code_vector(code_base_function))
+    vector_db.upsert_many(code_vectors, namespace='codebase')
 
-def get_until_no_space(all_lines, i) -> str:
+
+def index_codebase(full: bool = False) -> dict:
+    """
+    Bring the codebase namespace in line with the repository.  Files and functions whose
+    content hash matches the index manifest are skipped, so only added or changed functions
+    are summarised and embedded, and the vectors of removed functions are deleted.
+
+    Changed functions are streamed through the summarise -> embed -> upsert pipeline while
+    the remaining files are still being parsed.
+    """
+    with index_lock:
+        index_progress.start()
+        try:
+            stats = _index_codebase(full)
+        except Exception:
+            index_progress.finish('failed')
+            raise
+        index_progress.finish()
+        return stats
+
+
+def _index_codebase(full: bool) -> dict:
+    # A full run re-indexes every function, the old vectors keep answering searches until
+    # then and the ones of functions that no longer exist are deleted at the end
+    previous_ids = set()
+    if full:
+        for file_path in manifest.files:
+            previous_ids.update(manifest.functions(file_path))
+        manifest.clear()
+
+    file_paths = []
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        file_paths.extend(os.path.join(root, file) for file in files if file.endswith(".py"))
+    seen_files = set(file_paths)
+    changed_files = {}
+    deleted_ids = []
+    index_progress.add('files_total', len(file_paths))
+
+    pipeline = IndexingPipeline(summarize_function, embed_descriptions, upsert_functions, index_progress,
+                                summarize_workers=indexing_config.get("summarize_workers", 8),
+                                embed_workers=indexing_config.get("embed_workers", 2),
+                                upsert_workers=indexing_config.get("upsert_workers", 2),
+                                queue_size=indexing_config.get("queue_size", 256),
+                                embed_batch_size=indexing_config.get("embed_batch_size", 256),
+                                upsert_batch_size=indexing_config.get("upsert_batch_size", 100),
+                                completion_limiter=completion_limiter,
+                                embedding_limiter=embedding_limiter)
+    pipeline.start()
+    try:
+        # Parse the files whose content changed, in parallel, and queue the functions that changed
+        known_hashes = {file_path: manifest.file_hash(file_path) for file_path in file_paths}
+        for file_path, file_hash, definitions in extract_files(file_paths, known_hashes, extract_workers):
+            index_progress.add('files_scanned')
+            if definitions is None:
+                continue
+
+            previous_functions = manifest.functions(file_path)
+            functions = {}
+            for definition in definitions:
+                function_id = file_path + ':' + definition["qualified_name"]
+                code_hash = content_hash(definition["code"])
+                functions[function_id] = code_hash
+                if previous_functions.get(function_id) != code_hash:
+                    pipeline.submit({"id": function_id, "file_path": file_path, "definition": definition})
+            deleted_ids.extend(set(previous_functions) - set(functions))
+            changed_files[file_path] = (file_hash, functions)
+
+        removed_files = set(manifest.files) - seen_files
+        for file_path in removed_files:
+            deleted_ids.extend(manifest.functions(file_path))
+        if previous_ids:
+            current_ids = {function_id for _, functions in changed_files.values() for function_id in functions}
+            deleted_ids.extend(previous_ids - current_ids)
+    finally:
+        # Stop the stage threads also when parsing failed, they would block on their queues
+        failed_ids = pipeline.join()
+
+    # Drop the removed functions
+    if deleted_ids:
+        vector_db.delete_many(deleted_ids, namespace='codebase')
+        index_progress.add('deleted', len(deleted_ids))
+
+    # Only record the new state once the vector database has it.  Files with failed functions
+    # keep no file hash so the next run parses them again and retries just those functions.
+    for file_path, (file_hash, functions) in changed_files.items():
+        failed = failed_ids.intersection(functions)
+        if failed:
+            file_hash = None
+            functions = {function_id: code_hash for function_id, code_hash in functions.items()
+                         if function_id not in failed}
+        manifest.update_file(file_path, file_hash, functions)
+    for file_path in removed_files:
+        manifest.remove_file(file_path)
+    manifest.save()
+
+    progress = index_progress.snapshot()
+    logger.info(f'Indexed {repo_path}: {progress}')
+    return {"indexed": progress["upserted"], "deleted": len(deleted_ids),
+            "failed": len(failed_ids), "files": len(seen_files)}
+
+
+def start_indexing(full: bool = False) -> asyncio.Future:
     """
-    Get all lines until a line outside the function definition is found.
+    Run index_codebase on a worker thread.  Runs are serialised by index_lock, so a run
+    started while another is in progress begins once that one finishes.
     """
-    ret = [all_lines[i]]
-    for j in range(i + 1, i + 10000):
-        if j < len(all_lines):
-            if len(all_lines[j]) == 0 or all_lines[j][0] in [" ", "\t", ")"]:
-                ret.append(all_lines[j])
-            else:
-                break
-    return "\n".join(ret)
-
-
-def index_codebase():
-    # Iterate through the repository files and index their embeddings
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith(".py"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r") as f:
-                    code = f.read().replace("\r", "\n")
-                    all_lines = code.split("\n")
-                    for i, l in enumerate(all_lines):
-                        if l.startswith("def "):
-                            function_code = get_until_no_space(all_lines, i)
-                            function_name = get_function_name(function_code)
-                            logger.debug(f'indexing {function_name}')
-
-                            summary_prompt = f"""
-                            Please generate a brief 1 to 2 sentence description of the following function 
-                            ({function_name}) without any additional explanation:\n
-                            {function_code} 
-                            """
-                            code_description = generate_completion(summary_prompt)[0]
-
-                            # Generate the code embedding
-                            embedding = generate_embedding(code_description)
-
-                            code_base_function = CodeBaseFunction(
-                                id=file_path + ':' + function_name,
-                                function_name=function_name,
-                                file_path=file_path,
-                                code=function_code,
-                                embedding=embedding,
-                                description=code_description
-                            )
-
-                            # Add the code embedding to the vector database
-                            vector_db.add_code(code_base_function)
+    global indexing_task
+    # Run in a copy of the caller's context so the indexing spans join the caller's trace
+    indexing_task = asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run,
+                                                               index_codebase, full)
+    return indexing_task
 
 
 @app.on_event("startup")
 async def on_startup():
-    # Index the codebase on startup
+    # Index the codebase in the background so the service can take requests right away
     logger.info(f'Indexing {repo_path}')
-    index_codebase()
+    start_indexing()
 
 
-@app.get("/search_code")
-async def search_code(query: str, top_k: int = 5):
-    # Generate the query embedding
-    query_embedding = generate_embedding(query)
+@app.get("/index_status")
+async def index_status():
+    return index_progress.snapshot()
 
-    # Search the vector database
-    logging.debug(f'Querying codebase: {query}')
+
+async def wait_for_index(wait: bool) -> None:
+    # Answer from the partial index while indexing runs, unless asked to wait for it
+    if wait and indexing_task is not None and not indexing_task.done():
+        await asyncio.shield(indexing_task)
+
+
+def search_index(query_embedding: List[float], top_k: int, include_code: bool) -> CodeSearchResults:
     try:
         results = vector_db.search(query_embedding, top_k, namespace='codebase')
     except Exception as e:
@@ -110,20 +242,52 @@ async def search_code(query: str, top_k: int = 5):
         raise e
     logging.debug(results)
 
-    results_json = {
-        'matches': [str(match) for match in results['matches']],
-        'namespace': results['namespace'],
-    }
+    matches = []
+    for match in results['matches']:
+        metadata = match['metadata']
+        matches.append(CodeSearchMatch(id=match['id'], score=match['score'],
+                                       file_path=metadata['file_path'],
+                                       function_name=metadata['function_name'],
+                                       description=metadata['description'],
+                                       code=metadata.get('code') if include_code else None))
+    return CodeSearchResults(matches=matches, namespace=results['namespace'],
+                             index_state=index_progress.snapshot()['state'])
+
+
+# Matches leave out the code unless include_code is set
+@app.get("/search_code", response_model=CodeSearchResponse, response_model_exclude_none=True)
+async def search_code(query: str, top_k: int = 5, wait: bool = False, include_code: bool = False):
+    await wait_for_index(wait)
+
+    # Generate the query embedding
+    query_embedding = await agenerate_embedding(query, call_site='search_code')
+
+    # Search the vector database
+    logging.debug(f'Querying codebase: {query}')
+    return {"results": search_index(query_embedding, top_k, include_code)}
+
+
+@app.post("/search_code_batch", response_model=CodeSearchBatchResponse, response_model_exclude_none=True)
+async def search_code_batch(request: CodeSearchRequest, wait: bool = False):
+    await wait_for_index(wait)
 
-    # Return the search results
-    return {"results": results_json}
+    # One embedding request for all queries, the searches run side by side
+    query_embeddings = await agenerate_embeddings(request.queries, call_site='search_code')
+    logging.debug(f'Querying codebase with {len(request.queries)} queries')
+    results = await asyncio.gather(*(asyncio.to_thread(search_index, query_embedding, request.top_k,
+                                                       request.include_code)
+                                     for query_embedding in query_embeddings))
+    return {"results": results}
 
 
 @app.post("/update_codebase")
-async def update_codebase():
-    # Re-index the codebase
-    index_codebase()
-    return {"success": True, "message": "Codebase re-indexed"}
+async def update_codebase(full: bool = False, background: bool = False):
+    # Re-index what changed since the last index, or everything when full is set
+    task = start_indexing(full)
+    if background:
+        return {"success": True, "message": "Codebase re-indexing started"}
+    stats = await task
+    return {"success": True, "message": "Codebase re-indexed", **stats}
 
 # Add more Git-related functions as needed
 
@@ -135,12 +299,12 @@ async def update_code(new_file: ProjectFile):
 
     with open(os.path.join(repo_path, file_path), "w") as f:
         f.write(new_content)
-    repo.git.add(file_path)
+    run_git("add", file_path)
 
 
 @app.post("/commit_changes")
 async def commit_changes(commit_message: str):
-    repo.git.commit("-m", commit_message)
+    run_git("commit", "-m", commit_message)
 
 
 @app.post("/create_file")
@@ -154,33 +318,34 @@ async def create_file(new_file: ProjectFile):
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
     with open(file_path, "w") as f:
         f.write(new_file.content)
-    repo.git.add(all=True)
-    repo.git.add(os.path.dirname(file_path))
-    repo.git.add(file_path)
-    repo.git.commit("-m", f"Create new file: {file_path}")
+    run_git("add", all=True)
+    run_git("add", os.path.dirname(file_path))
+    run_git("add", file_path)
+    run_git("commit", "-m", f"Create new file: {file_path}")
 
 
 @app.post("/create_branch")
 async def create_branch(branch_name: str):
-    repo.git.checkout("-b", branch_name)
+    run_git("checkout", "-b", branch_name)
 
 
 @app.post("/fetch_and_pull")
 async def fetch_and_pull(remote_name: str = "origin", branch_name: str = "main"):
-    repo.git.fetch(remote_name)
-    repo.git.pull(remote_name, branch_name)
+    run_git("fetch", remote_name)
+    run_git("pull", remote_name, branch_name)
 
 
 @app.get("/get_commit_history")
 async def get_commit_history():
     commit_history = []
-    for commit in repo.iter_commits():
-        commit_history.append({
-            "commit_id": commit.hexsha,
-            "author": commit.author.name,
-            "date": commit.authored_datetime,
-            "message": commit.message
-        })
+    with span('git log', 'git'):
+        for commit in repo.iter_commits():
+            commit_history.append({
+                "commit_id": commit.hexsha,
+                "author": commit.author.name,
+                "date": commit.authored_datetime,
+                "message": commit.message
+            })
     return {"commit_history": commit_history}
 
 
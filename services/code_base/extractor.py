@@ -0,0 +1,125 @@
+import ast
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+from services.code_base.index_manifest import content_hash
+
+logger = logging.getLogger(__name__)
+
+# Below this many files the process pool costs more than it saves
+PARALLEL_THRESHOLD = 16
+
+
+def _pool_context():
+    # The pool is created while the indexing pipeline's threads run, a forked worker would
+    # inherit their locks in whatever state they were.  Start workers from a clean process.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_function_name(code):
+    """
+    Extract function name from a line beginning with "def "
+    """
+    assert code.startswith("def ")
+    return code[len("def "): code.index("(")]
+
+
+def get_until_no_space(all_lines, i) -> str:
+    """
+    Get all lines until a line outside the function definition is found.
+    """
+    ret = [all_lines[i]]
+    for j in range(i + 1, len(all_lines)):
+        if len(all_lines[j]) == 0 or all_lines[j][0] in [" ", "\t", ")"]:
+            ret.append(all_lines[j])
+        else:
+            break
+    return "\n".join(ret)
+
+
+def _scan_definitions(code: str) -> List[dict]:
+    # Line based fallback for files that do not parse, only finds top level functions
+    all_lines = code.split("\n")
+    definitions = []
+    for i, l in enumerate(all_lines):
+        if l.startswith("def "):
+            function_code = get_until_no_space(all_lines, i)
+            definitions.append({"qualified_name": get_function_name(function_code),
+                                "kind": "function",
+                                "start_line": i + 1,
+                                "end_line": i + function_code.count("\n") + 1,
+                                "code": function_code})
+    return definitions
+
+
+def extract_definitions(code: str) -> List[dict]:
+    """
+    Parse a file once and return every function, method and class in it with its dotted
+    qualified name, kind, 1-based inclusive line span (decorators included) and source.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError) as e:
+        logger.warning(f'Falling back to line scanning, file does not parse: {e}')
+        return _scan_definitions(code)
+
+    all_lines = code.split("\n")
+    definitions = []
+
+    def visit(node, prefix: str, in_class: bool):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                qualified_name = prefix + child.name
+                if isinstance(child, ast.ClassDef):
+                    kind = "class"
+                elif in_class:
+                    kind = "method"
+                else:
+                    kind = "async_function" if isinstance(child, ast.AsyncFunctionDef) else "function"
+                start_line = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                definitions.append({"qualified_name": qualified_name,
+                                    "kind": kind,
+                                    "start_line": start_line,
+                                    "end_line": child.end_lineno,
+                                    "code": "\n".join(all_lines[start_line - 1:child.end_lineno])})
+                visit(child, qualified_name + ".", isinstance(child, ast.ClassDef))
+            else:
+                visit(child, prefix, in_class)
+
+    visit(tree, "", False)
+    return definitions
+
+
+def extract_file(file_path: str, known_hash: Optional[str] = None) -> Tuple[str, str, Optional[List[dict]]]:
+    """
+    Read and parse one file.  Returns (file_path, content hash, definitions), definitions is
+    None when the content hash equals known_hash and the file was not parsed.  The hash is
+    None as well when the file could not be read.
+    """
+    try:
+        with open(file_path, "r") as f:
+            code = f.read().replace("\r", "\n")
+    except (OSError, UnicodeDecodeError) as e:
+        logger.warning(f'Could not read {file_path}: {e}')
+        return file_path, None, None
+    file_hash = content_hash(code)
+    if file_hash == known_hash:
+        return file_path, file_hash, None
+    return file_path, file_hash, extract_definitions(code)
+
+
+def extract_files(file_paths: List[str], known_hashes: Dict[str, str] = None,
+                  max_workers: int = None) -> Iterator[Tuple[str, str, Optional[List[dict]]]]:
+    """
+    Run extract_file over many files, in a process pool when there are enough of them.
+    """
+    known_hashes = known_hashes or {}
+    hashes = [known_hashes.get(file_path) for file_path in file_paths]
+    if len(file_paths) < PARALLEL_THRESHOLD or max_workers == 1:
+        yield from map(extract_file, file_paths, hashes)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=_pool_context()) as executor:
+        yield from executor.map(extract_file, file_paths, hashes, chunksize=8)
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from typing import Dict
+import logging
+from shared_utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class IndexManifest:
+    """
+    Records what the codebase namespace currently holds: for every indexed file the hash of
+    its content and the hash of each function's code, keyed by function id.  Comparing a
+    fresh walk of the repo against it tells which functions need to be re-summarised and
+    which vectors need to be deleted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files: Dict[str, dict] = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.files = json.load(f)['files']
+
+    def file_hash(self, file_path: str):
+        return self.files.get(file_path, {}).get('hash')
+
+    def functions(self, file_path: str) -> Dict[str, str]:
+        return self.files.get(file_path, {}).get('functions', {})
+
+    def update_file(self, file_path: str, file_hash: str, functions: Dict[str, str]) -> None:
+        self.files[file_path] = {'hash': file_hash, 'functions': functions}
+
+    def remove_file(self, file_path: str) -> Dict[str, str]:
+        return self.files.pop(file_path, {}).get('functions', {})
+
+    def clear(self) -> None:
+        self.files = {}
+
+    def save(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files}, f)
+        os.replace(tmp_path, self.path)
+        logger.debug(f'Saved index manifest with {len(self.files)} files')
@@ -0,0 +1,210 @@
+import contextvars
+import queue
+import threading
+import time
+from typing import Callable, List
+import logging
+from shared_utils.logging_config import setup_logging
+from shared_utils.rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream on a stage's input queue
+_DONE = object()
+
+
+class IndexProgress:
+    """
+    Thread safe counters for one indexing run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = 'idle'
+            self.started_at = None
+            self.finished_at = None
+            self.counts = {'files_total': 0, 'files_scanned': 0, 'queued': 0, 'summarized': 0, 'embedded': 0,
+                           'upserted': 0, 'deleted': 0, 'failed': 0}
+
+    def start(self):
+        self.reset()
+        with self._lock:
+            self.state = 'running'
+            self.started_at = time.time()
+
+    def finish(self, state: str = 'done'):
+        with self._lock:
+            self.state = state
+            self.finished_at = time.time()
+
+    def add(self, counter: str, count: int = 1):
+        with self._lock:
+            self.counts[counter] += count
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            return {'state': self.state, 'elapsed_seconds': round(elapsed, 1),
+                    'eta_seconds': self._eta(elapsed), **self.counts}
+
+    def _eta(self, elapsed: float):
+        if self.state != 'running':
+            return 0.0 if self.state == 'done' else None
+        counts = self.counts
+        finished = counts['upserted'] + counts['failed']
+        if not finished or not counts['files_scanned']:
+            return None
+        # While files are still being parsed, extrapolate the number of changed functions
+        # from the files parsed so far
+        expected = counts['queued'] * counts['files_total'] / counts['files_scanned']
+        rate = finished / elapsed
+        return round(max(expected - finished, 0) / rate, 1)
+
+
+class IndexingPipeline:
+    """
+    Summarise -> embed -> upsert stages connected by bounded queues, each stage served by
+    its own pool of worker threads.  Work items are dicts with at least an 'id'; the
+    summarise stage adds 'description', the embed stage adds 'embedding' and the upsert
+    stage receives lists of items.  The embed and upsert stages batch whatever is waiting
+    on their queue, up to their batch size.
+
+    Failed calls are retried with exponential backoff, items that still fail are counted
+    and reported by join() so the caller can retry them on the next run.
+    """
+
+    def __init__(self, summarize: Callable[[dict], str], embed: Callable[[List[str]], List[List[float]]],
+                 upsert: Callable[[List[dict]], None], progress: IndexProgress,
+                 summarize_workers: int = 8, embed_workers: int = 2, upsert_workers: int = 2,
+                 queue_size: int = 256, embed_batch_size: int = 256, upsert_batch_size: int = 100,
+                 completion_limiter: RateLimiter = None, embedding_limiter: RateLimiter = None,
+                 max_retries: int = 3):
+        self._summarize = summarize
+        self._embed = embed
+        self._upsert = upsert
+        self.progress = progress
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.completion_limiter = completion_limiter
+        self.embedding_limiter = embedding_limiter
+        self.max_retries = max_retries
+
+        self._summarize_queue = queue.Queue(maxsize=queue_size)
+        self._embed_queue = queue.Queue(maxsize=queue_size)
+        self._upsert_queue = queue.Queue(maxsize=queue_size)
+        self._failed_lock = threading.Lock()
+        self.failed_ids = set()
+
+        self._stages = [
+            (self._summarize_worker, summarize_workers, self._summarize_queue, self._embed_queue),
+            (self._embed_worker, embed_workers, self._embed_queue, self._upsert_queue),
+            (self._upsert_worker, upsert_workers, self._upsert_queue, None),
+        ]
+        self._threads = []
+
+    def start(self) -> None:
+        for worker, count, _, _ in self._stages:
+            # Each worker runs in a copy of the caller's context, so its spans join the caller's trace
+            threads = [threading.Thread(target=contextvars.copy_context().run, args=(worker,),
+                                        name=f'{worker.__name__}-{i}', daemon=True)
+                       for i in range(count)]
+            for thread in threads:
+                thread.start()
+            self._threads.append(threads)
+
+    def submit(self, item: dict) -> None:
+        """Queue an item for summarising, blocks while the first stage is full."""
+        self.progress.add('queued')
+        self._summarize_queue.put(item)
+
+    def join(self) -> set:
+        """Wait for every submitted item to pass through all stages and return the failed ids."""
+        for (_, count, input_queue, _), threads in zip(self._stages, self._threads):
+            # Each stage is closed once the stage before it has drained
+            for _ in range(count):
+                input_queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+        return self.failed_ids
+
+    def _fail(self, items: List[dict], error: Exception) -> None:
+        logger.error(f'Indexing failed for {len(items)} functions: {error}')
+        self.progress.add('failed', len(items))
+        with self._failed_lock:
+            self.failed_ids.update(item['id'] for item in items)
+
+    def _call(self, limiter: RateLimiter, function, *args):
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 2 ** attempt
+                logger.warning(f'{function.__name__} failed ({e}), retrying in {delay}s')
+                time.sleep(delay)
+
+    def _take_batch(self, input_queue: queue.Queue, batch_size: int):
+        """Block for one item, then drain what is already waiting.  Returns (items, done)."""
+        item = input_queue.get()
+        if item is _DONE:
+            return [], True
+        batch = [item]
+        while len(batch) < batch_size:
+            try:
+                item = input_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _summarize_worker(self):
+        while True:
+            item = self._summarize_queue.get()
+            if item is _DONE:
+                return
+            try:
+                item['description'] = self._call(self.completion_limiter, self._summarize, item)
+            except Exception as e:
+                self._fail([item], e)
+                continue
+            self.progress.add('summarized')
+            self._embed_queue.put(item)
+
+    def _embed_worker(self):
+        done = False
+        while not done:
+            batch, done = self._take_batch(self._embed_queue, self.embed_batch_size)
+            if not batch:
+                continue
+            try:
+                embeddings = self._call(self.embedding_limiter, self._embed, [item['description'] for item in batch])
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            for item, embedding in zip(batch, embeddings):
+                item['embedding'] = embedding
+                self._upsert_queue.put(item)
+            self.progress.add('embedded', len(batch))
+
+    def _upsert_worker(self):
+        done = False
+        while not done:
+            batch, done = self._take_batch(self._upsert_queue, self.upsert_batch_size)
+            if not batch:
+                continue
+            try:
+                self._call(None, self._upsert, batch)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            self.progress.add('upserted', len(batch))
@@ -1,59 +1,89 @@
 from shared_utils.configurations import configurations
 from shared_utils.models import WorkItemUpdate
+from shared_utils.service_client import service_get, service_post, service_stream, close_client
+from shared_utils.streaming import Emit, respond
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 import logging
 from shared_utils.logging_config import setup_logging
-import httpx
-import requests
+import asyncio
 import uvicorn
 import json
 
 
 app = FastAPI()
+install_metrics(app, 'daily_standup')
+install_tracing(app, 'daily_standup')
 logger = logging.getLogger(__name__)
 
-host = configurations.get("microservices", "sprint_planning", "hostname")
-port = configurations.get("microservices", "sprint_planning", "port")
-sprint_planning_address = f'http://{host}:{port}'
+# Backlog items sent to the developer service at once.  The code base is re-indexed after
+# each batch so the next batch can find the code the previous one wrote.
+developer_workers = configurations.get('daily_standup', 'developer_workers', default=4)
 
-host = configurations.get("microservices", "developer", "hostname")
-port = configurations.get("microservices", "developer", "port")
-developer_address = f'http://{host}:{port}'
-
-host = configurations.get("microservices", "tester", "hostname")
-port = configurations.get("microservices", "tester", "port")
-tester_address = f'http://{host}:{port}'
-
-host = configurations.get("microservices", "code_base", "hostname")
-port = configurations.get("microservices", "code_base", "port")
-code_base_address = f'http://{host}:{port}'
 
 async def get_sprint_backlog():
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{sprint_planning_address}/get_sprint_backlog")
+    response = await service_get('sprint_planning', '/get_sprint_backlog')
     return response.json()
 
 
-@app.post("/daily_standup")
-async def daily_standup():
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_client()
+
+
+async def work_on_item(backlog_item: dict, emit: Emit) -> dict:
+    logger.debug(backlog_item)
+    result = {"id": backlog_item.get("id"), "description": backlog_item["item"]["description"]}
+
+    # The developer streams its progress, which is passed on tagged with the item
+    def relay(event: dict) -> None:
+        emit({**event, "item_id": result["id"]})
+
+    try:
+        outcome = await service_stream('POST', 'developer', '/work_on_item', relay, json=backlog_item)
+    except Exception as e:
+        logger.error(f'Work on item {result["id"]} failed: {e!r}')
+        outcome = {"event": "error", "message": repr(e)}
+
+    # work_item_update: WorkItemUpdate = WorkItemUpdate(**response.json())
+
+    # TODO Add the tester
+    #if work_item_update.is_updated:
+    #    await service_post('tester', '/test_and_report', json=work_item_update.dict())
+
+    success = outcome["event"] == "done"
+    if success:
+        try:
+            await service_post('sprint_planning', '/complete_item', params={"item_id": result["id"]})
+        except Exception as e:
+            logger.error(f'Could not mark item {result["id"]} completed: {e!r}')
+    else:
+        logger.error(f'Work on item {result["id"]} failed: {outcome.get("message")}')
+    result = {**result, "success": success, "message": outcome.get("message", "")}
+    emit({"event": "item_completed", **result})
+    return result
+
+
+async def run_standup(emit: Emit) -> dict:
     sprint_backlog = await get_sprint_backlog()
 
-    while sprint_backlog:
-        backlog_item = sprint_backlog.pop(0)
-        logger.debug(backlog_item)
-        response = requests.post(developer_address + '/work_on_item', json=backlog_item)
-        response = requests.post(code_base_address + '/update_codebase')
+    results = []
+    for start in range(0, len(sprint_backlog), developer_workers):
+        batch = sprint_backlog[start:start + developer_workers]
+        results.extend(await asyncio.gather(*(work_on_item(backlog_item, emit) for backlog_item in batch)))
+        await service_post('code_base', '/update_codebase')
+        emit({"event": "codebase_updated", "items_done": len(results), "items_total": len(sprint_backlog)})
 
-        # async with httpx.AsyncClient(timeout=120.0) as client:
-        #     response = await client.post(f"{developer_address}/work_on_item", json=backlog_item)
-            # work_item_update: WorkItemUpdate = WorkItemUpdate(**response.json())
+    completed = sum(result["success"] for result in results)
+    return {"success": completed == len(results),
+            "message": f"Daily standups completed, {completed} of {len(results)} items done",
+            "items": results}
 
-        # TODO Add the tester
-        #if work_item_update.is_updated:
-        #    async with httpx.AsyncClient() as client:
-        #        await client.post(f"{tester_address}/test_and_report", json=work_item_update.dict())
 
-    return {"success": True, "message": "Daily standups completed"}
+@app.post("/daily_standup")
+async def daily_standup(stream: bool = False):
+    return await respond(run_standup, stream)
 
 
 if __name__ == '__main__':
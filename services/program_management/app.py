@@ -1,48 +1,31 @@
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 import logging
 from shared_utils.logging_config import setup_logging
 from shared_utils.models import ProductVision, ProjectStructure
 from shared_utils.configurations import configurations
-from shared_utils.nlp import generate_chat_completion, extract_json_string
+from shared_utils.nlp import agenerate_chat_completion, extract_json_string
 from shared_utils.context import Context
-import requests
+from shared_utils.service_client import service_post, service_stream, close_client
+from shared_utils.streaming import Emit, respond
 import uvicorn
 import json
 import os
 
 app = FastAPI()
+install_metrics(app, 'program_management')
+install_tracing(app, 'program_management')
 context = Context()
 logger = logging.getLogger(__name__)
 
 backlog_item_remaining = configurations.get('program_management', 'items_per_sprint')
 
-# Define the agent microservices' addresses
-
-host = configurations.get('microservices', 'sprint_planning', 'hostname')
-port = configurations.get('microservices', 'sprint_planning', 'port')
-ai_sprint_planning_address = f"http://{host}:{port}"
-
-host = configurations.get('microservices', 'product_owner', 'hostname')
-port = configurations.get('microservices', 'product_owner', 'port')
-ai_product_owner_address = f"http://{host}:{port}"
-
-host = configurations.get('microservices', 'daily_standup', 'hostname')
-port = configurations.get('microservices', 'daily_standup', 'port')
-daily_standup_address = f"http://{host}:{port}"
-
-host = configurations.get('microservices', 'sprint_review', 'hostname')
-port = configurations.get('microservices', 'sprint_review', 'port')
-sprint_review_address = f"http://{host}:{port}"
-
-host = configurations.get('microservices', 'code_base', 'hostname')
-port = configurations.get('microservices', 'code_base', 'port')
-code_base_address = f"http://{host}:{port}"
-
 # Define a list of agent microservices to call in sequence
 agents = [
-    (ai_sprint_planning_address, "/sprint_planning"),
-    (daily_standup_address, "/daily_standup"),
-    # (sprint_review_address, "/sprint_review")
+    ('sprint_planning', "/sprint_planning"),
+    ('daily_standup', "/daily_standup"),
+    # ('sprint_review', "/sprint_review")
 ]
 
 
@@ -81,18 +64,23 @@ async def generate_project_structure(vision: ProductVision) -> ProjectStructure:
         {"role": "user", "content": prompt}
     ]
 
-    project_structure_response = generate_chat_completion(messages, max_tokens=2049)
+    project_structure_response = await agenerate_chat_completion(messages, max_tokens=2049,
+                                                                 call_site='generate_project_structure')
     project_structure_string = extract_json_string(project_structure_response)
 
     logger.debug(project_structure_string)
 
-    context.add_project_vision(vision)
-    context.add_project_structure(project_structure_string)
+    await context.aadd_project_context(vision, project_structure_string)
     project_structure_mapping = json.loads(project_structure_string)
 
     return ProjectStructure(**project_structure_mapping)
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_client()
+
+
 @app.post("/create_project")
 async def create_project(vision: ProductVision):
     project_structure = await generate_project_structure(vision)
@@ -115,25 +103,34 @@ async def create_project(vision: ProductVision):
         logger.debug('Creating file:')
         logger.debug(data)
 
-        response = requests.post(code_base_address + '/create_file', json=data)
+        response = await service_post('code_base', '/create_file', json=data)
 
     return {"success": True, "message": "Project structure created", "project_structure": project_structure}
 
 
-@app.post("/start_sprint")
-async def start_sprint(vision: ProductVision):
+async def run_sprint(emit: Emit) -> dict:
     # TODO figure out where the create project belongs
     # await create_project(vision)
-    for address, endpoint in agents:
-        response = requests.post(f"{address}{endpoint}")
-        if response.status_code != 200:
+    for service, endpoint in agents:
+        # The agents stream their progress, which is passed on tagged with the stage
+        def relay(event: dict) -> None:
+            emit({**event, "stage": service})
+
+        outcome = await service_stream('POST', service, endpoint, relay)
+        if outcome["event"] != "done":
             return {
                 "success": False,
-                "message": f"Error occurred while executing {endpoint} at {address}"
+                "message": f"Error occurred while executing {endpoint} at {service}"
             }
+        emit({"event": "stage_completed", "stage": service, "message": outcome.get("message", "")})
     return {"success": True, "message": "Sprint completed"}
 
 
+@app.post("/start_sprint")
+async def start_sprint(vision: ProductVision, stream: bool = False):
+    return await respond(run_sprint, stream)
+
+
 if __name__ == '__main__':
     port = configurations.get('microservices', 'program_management', 'port')
     uvicorn.run(app, port=port)
@@ -1,70 +1,103 @@
 from fastapi import FastAPI
+from shared_utils.metrics import install_metrics
+from shared_utils.tracing import install_tracing
 from typing import List
 import logging
 from shared_utils.logging_config import setup_logging
 from shared_utils.models import BacklogItem
-from shared_utils.nlp import generate_chat_completion, generate_embedding
+from shared_utils.nlp import agenerate_chat_completion, agenerate_embeddings, CACHE_ALWAYS
 from shared_utils.configurations import configurations
 from shared_utils.backlog import BacklogWithEmbedding
+from shared_utils.service_client import service_get, close_client
+from shared_utils.streaming import Emit, respond
+import asyncio
 import json
 import uvicorn
-import requests
 
 app = FastAPI()
+install_metrics(app, 'sprint_planning')
+install_tracing(app, 'sprint_planning')
 logger = logging.getLogger(__name__)
 
 number_of_items = configurations.get('program_management', 'items_per_sprint')
 sprint_backlog_namespace = configurations.get('pinecone', 'sprint_backlog_namespace')
 
-host = configurations.get('microservices', 'backlog', 'hostname')
-port = configurations.get('microservices', 'backlog', 'port')
-product_backlog_address = f"http://{host}:{port}"
 
+sprint_backlog = BacklogWithEmbedding('sprint_backlog')
 
-sprint_backlog = BacklogWithEmbedding()
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_client()
 
-@app.post("/sprint_planning")
-async def sprint_planning():
+
+async def decompose_item(item: dict, emit: Emit) -> List[str]:
+    prompt = f"""You are the team member responsible for sprint planning. 
+    You are an expert at considering the perspectives of your AI development team. 
+    Your current task is to decompose a backlog item for a sprint. The backlog item is:
+    '{item['item']['description']}'
+    Please provide a list of smaller tasks to complete this backlog item in priority order.
+    The tasks should be as fine-grained as possible and only include code implementation tasks.
+    The AI developers these will be assigned to can only create, update, and remove python code.
+    Respond with a new line delimited list of tasks and do not include any additional explanation."""
+
+    messages = [
+        {"role": "system", "content": "You are an AI member of an agile software development team."},
+        {"role": "user", "content": prompt}
+    ]
+
+    # Each task is reported as soon as its line of the reply has arrived
+    def on_line(line: str) -> None:
+        if line.strip():
+            emit({"event": "task_decomposed", "item_id": item.get('id'), "task": line})
+
+    # Reuse the decomposition when a sprint is retried
+    completions = await agenerate_chat_completion(messages, max_tokens=2000, cache_policy=CACHE_ALWAYS,
+                                                  call_site='sprint_decomposition', on_line=on_line)
+    tasks = [task for task in completions.split('\n') if task.strip()]
+    emit({"event": "item_decomposed", "item_id": item.get('id'), "tasks": tasks})
+    return tasks
+
+
+async def plan_sprint(emit: Emit) -> dict:
     # Retrieve the top N backlog items from the product backlog service
-    response = requests.get(product_backlog_address + f"/get_top_items?number_of_items={number_of_items}")
+    response = await service_get('backlog', '/get_top_items', params={"number_of_items": number_of_items})
     logging.debug(response)
     backlog_items = json.loads(response.text)["backlog_items"]
     logger.debug('Backlog items')
     logger.debug(backlog_items)
 
-    # Decompose backlog items using the NLP completion function
-    for item in backlog_items:
-        prompt = f"""You are the team member responsible for sprint planning. 
-        You are an expert at considering the perspectives of your AI development team. 
-        Your current task is to decompose a backlog item for a sprint. The backlog item is:
-        '{item['item']['description']}'
-        Please provide a list of smaller tasks to complete this backlog item in priority order.
-        The tasks should be as fine-grained as possible and only include code implementation tasks.
-        The AI developers these will be assigned to can only create, update, and remove python code.
-        Respond with a new line delimited list of tasks and do not include any additional explanation."""
-
-        messages = [
-            {"role": "system", "content": "You are an AI member of an agile software development team."},
-            {"role": "user", "content": prompt}
-        ]
-
-        completions = generate_chat_completion(messages, max_tokens=2000)
-        tasks = completions.split('\n')
-
-        # Store the decomposed tasks in the sprint backlog
-        for i, task in enumerate(tasks):
-            sprint_task = BacklogItem(priority=i, item={'description': task})
-            embedding = generate_embedding(task)
-            sprint_backlog.add_item(sprint_task, embedding, sprint_backlog_namespace)
+    # Decompose the backlog items concurrently
+    decompositions = await asyncio.gather(*(decompose_item(item, emit) for item in backlog_items))
+    tasks = [task for item_tasks in decompositions for task in item_tasks]
+
+    # Store the decomposed tasks in the sprint backlog, embedded in one batch and upserted at once
+    sprint_tasks = []
+    for item_tasks in decompositions:
+        sprint_tasks.extend(BacklogItem(priority=i, item={'description': task}) for i, task in enumerate(item_tasks))
+    if sprint_tasks:
+        embeddings = await agenerate_embeddings(tasks, call_site='sprint_tasks')
+        sprint_backlog.add_items(sprint_tasks, embeddings, sprint_backlog_namespace)
 
     return {"success": True, "message": f"{number_of_items} backlog items decomposed and added to the sprint backlog"}
 
 
+@app.post("/sprint_planning")
+async def sprint_planning(stream: bool = False):
+    return await respond(plan_sprint, stream)
+
+
 @app.get("/get_sprint_backlog")
 async def get_sprint_backlog():
     return [item.__dict__ for item in sprint_backlog.get_backlog()]
 
+
+@app.post("/complete_item")
+async def complete_item(item_id: str):
+    # Done tasks leave the sprint backlog so later standups do not work on them again
+    sprint_backlog.delete_item(item_id, namespace=sprint_backlog_namespace)
+    return {"success": True, "message": f"Sprint backlog item {item_id} completed"}
+
 if __name__ == '__main__':
     port = configurations.get('microservices', 'sprint_planning', 'port')
     uvicorn.run(app, port=port)
@@ -0,0 +1,378 @@
+import base64
+import fcntl
+import json
+import os
+import threading
+import numpy as np
+from typing import List, Any, Dict
+from shared_utils.ivf_index import IVFIndex
+from shared_utils.models import BacklogItem, CodeBaseFunction
+from shared_utils.vector_database_base import VectorDatabaseBase, backlog_item_vector, code_vector
+import logging
+from shared_utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Namespace:
+    """
+    One namespace of the local store: a contiguous float32 matrix of unit-length rows,
+    the ids of those rows and their metadata.  Deletes swap the last row into the hole
+    so the live rows are always matrix[:size].  When an IVF index is attached, queries go
+    through it instead of scoring every row.
+
+    On disk a namespace is a snapshot, the matrix as .npy and meta.json with the ids and
+    metadata, plus meta.log with the upserts and deletes made since.  A write appends one
+    line to the log, the snapshot is only rewritten once the log has outgrown it.  Other
+    processes catch up by replaying the lines they have not seen yet.
+
+    `lock` serialises the threads of this process: loads, writes and reads of the arrays all
+    happen while holding it.
+    """
+
+    # The log is folded into a new snapshot once it is larger than this and the snapshot
+    min_compact_bytes = 1 << 20
+
+    def __init__(self, directory: str, ann: IVFIndex = None):
+        self.directory = directory
+        self.ann = ann
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+        self.ids = []
+        self.metadata = []
+        self.positions = {}
+        self.generation = 0
+        self.loaded_version = None
+        self._log_offset = 0
+        self._snapshot_bytes = 0
+        # Log entries of the changes made since the last save
+        self._pending = []
+
+    def vectors_path(self, generation: int) -> str:
+        name = 'vectors.npy' if generation == 0 else f'vectors.{generation}.npy'
+        return os.path.join(self.directory, name)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    @property
+    def log_path(self):
+        return os.path.join(self.directory, 'meta.log')
+
+    @property
+    def ann_path(self):
+        return os.path.join(self.directory, 'ivf.npz')
+
+    def disk_version(self):
+        """The snapshot's mtime and the log's length, None while nothing has been saved."""
+        try:
+            snapshot = os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        try:
+            log_size = os.stat(self.log_path).st_size
+        except FileNotFoundError:
+            log_size = 0
+        return snapshot, log_size
+
+    def load(self):
+        version = self.disk_version()
+        if version is None:
+            self._reset()
+            return
+        if self.loaded_version is None or version[0] != self.loaded_version[0] or version[1] < self._log_offset:
+            self._load_snapshot()
+        # Apply what was logged since the snapshot, or since the last load
+        self._replay()
+        self._pending = []
+        self.loaded_version = version
+
+    def _load_snapshot(self):
+        with open(self.meta_path, 'r') as f:
+            meta = json.load(f)
+        self.generation = meta.get('generation', 0)
+        # Memory-map the matrix so a restart does not have to read it up front.
+        # It is copied into a growable array on the first write.
+        self.matrix = np.load(self.vectors_path(self.generation), mmap_mode='r')
+        self.size = len(meta['ids'])
+        self.ids = meta['ids']
+        self.metadata = meta['metadata']
+        self.positions = {vector_id: i for i, vector_id in enumerate(self.ids)}
+        if self.ann is not None:
+            self.ann.load(self.ann_path, self.ids, self.matrix[:self.size])
+        self._snapshot_bytes = self.matrix[:self.size].nbytes
+        self._log_offset = 0
+
+    def _replay(self):
+        try:
+            log = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with log:
+            log.seek(self._log_offset)
+            for line in log:
+                if not line.endswith(b'\n'):
+                    # Cut short by a crash while appending
+                    break
+                self._log_offset += len(line)
+                entry = json.loads(line)
+                if entry['generation'] != self.generation:
+                    # Logged before the snapshot was taken, the snapshot has it
+                    continue
+                if entry['op'] == 'upsert':
+                    self.upsert([{'id': vector['id'], 'metadata': vector['metadata'],
+                                  'values': np.frombuffer(base64.b64decode(vector['values']), dtype=np.float32)}
+                                 for vector in entry['vectors']])
+                else:
+                    self.delete(entry['ids'])
+
+    def save(self):
+        if not self._pending:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        lines = b''.join((json.dumps({'generation': self.generation, **entry}) + '\n').encode('utf-8')
+                         for entry in self._pending)
+        self._pending = []
+        if self.loaded_version is None or \
+                self._log_offset + len(lines) > max(self.min_compact_bytes, self._snapshot_bytes):
+            self._save_snapshot()
+        else:
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                written = 0
+                while written < len(lines):
+                    written += os.write(fd, lines[written:])
+            finally:
+                os.close(fd)
+            self._log_offset += len(lines)
+        self.loaded_version = self.disk_version()
+
+    def _save_snapshot(self):
+        # A new generation gets new file names, meta.json switches to it in one rename
+        generation = self.generation + 1
+        vectors_tmp = self.vectors_path(generation) + '.tmp'
+        with open(vectors_tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.matrix[:self.size]))
+        os.replace(vectors_tmp, self.vectors_path(generation))
+        if self.ann is not None:
+            self.ann.save(self.ann_path)
+
+        meta_tmp = self.meta_path + '.tmp'
+        with open(meta_tmp, 'w') as f:
+            json.dump({'generation': generation, 'ids': self.ids, 'metadata': self.metadata}, f)
+        os.replace(meta_tmp, self.meta_path)
+        # The logged entries are in the snapshot now
+        open(self.log_path, 'wb').close()
+        try:
+            os.remove(self.vectors_path(self.generation))
+        except FileNotFoundError:
+            pass
+
+        self.generation = generation
+        self._log_offset = 0
+        self._snapshot_bytes = self.matrix[:self.size].nbytes
+
+    def _reserve(self, rows: int, dimension: int):
+        if self.size == 0 and self.matrix.shape[1] != dimension:
+            self.matrix = np.zeros((max(rows, 16), dimension), dtype=np.float32)
+            return
+        if self.matrix.shape[1] != dimension:
+            raise ValueError(f'Vector dimension {dimension} does not match namespace dimension '
+                             f'{self.matrix.shape[1]}')
+        needed = self.size + rows
+        if needed > self.matrix.shape[0] or not self.matrix.flags.writeable:
+            capacity = max(needed, 2 * self.matrix.shape[0], 16)
+            grown = np.zeros((capacity, dimension), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+
+    def upsert(self, vectors: List[dict]):
+        values = np.asarray([vector['values'] for vector in vectors], dtype=np.float32)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        values /= norms
+
+        self._reserve(len(vectors), values.shape[1])
+        for vector, row in zip(vectors, values):
+            position = self.positions.get(vector['id'])
+            if position is None:
+                position = self.size
+                self.size += 1
+                self.ids.append(vector['id'])
+                self.metadata.append(None)
+                self.positions[vector['id']] = position
+            self.matrix[position] = row
+            self.metadata[position] = vector.get('metadata', {})
+        if self.ann is not None:
+            self.ann.add([vector['id'] for vector in vectors], values)
+        self._pending.append({'op': 'upsert', 'vectors': [
+            {'id': vector['id'], 'metadata': vector.get('metadata', {}),
+             'values': base64.b64encode(row.tobytes()).decode('ascii')} for vector, row in zip(vectors, values)]})
+
+    def delete(self, vector_ids: List[str]):
+        if not self.matrix.flags.writeable:
+            self._reserve(0, self.matrix.shape[1])
+        for vector_id in vector_ids:
+            position = self.positions.pop(vector_id, None)
+            if position is None:
+                continue
+            last = self.size - 1
+            if position != last:
+                self.matrix[position] = self.matrix[last]
+                self.ids[position] = self.ids[last]
+                self.metadata[position] = self.metadata[last]
+                self.positions[self.ids[position]] = position
+            self.ids.pop()
+            self.metadata.pop()
+            self.size -= 1
+        if self.ann is not None:
+            self.ann.remove(vector_ids)
+        self._pending.append({'op': 'delete', 'ids': list(vector_ids)})
+
+    def query(self, query_vector: List[float], top_k: int):
+        if self.size == 0 or top_k < 1:
+            return [], []
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        if self.ann is not None and self.ann.trained:
+            ids, scores = self.ann.search(query, top_k)
+            return [self.positions[vector_id] for vector_id in ids], scores
+
+        scores = self.matrix[:self.size] @ query
+        top_k = min(top_k, self.size)
+        if top_k < self.size:
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(self.size)
+        order = candidates[np.argsort(-scores[candidates])]
+        return order, scores[order]
+
+
+class NumpyDatabase(VectorDatabaseBase):
+    """
+    In-process vector store for single node deployments.  Each namespace lives in
+    `<path>/<namespace>/` as a float32 .npy matrix plus a JSON sidecar with ids and metadata,
+    and a log of the writes made since.  Services on the same host share the files: every
+    write is done under an exclusive file lock and readers catch up on a namespace when
+    another process has written it.  Threads of one process share a namespace under its lock.
+
+    Namespaces listed in `ann_namespaces` are additionally indexed with an IVFIndex built
+    with `ann_params` (nlist, nprobe, ...) for approximate search.
+    """
+
+    def __init__(self, path: str, ann_namespaces: List[str] = None, ann_params: dict = None):
+        self.path = path
+        self.ann_namespaces = set(ann_namespaces or [])
+        self.ann_params = ann_params or {}
+        self._namespaces: Dict[str, _Namespace] = {}
+        self._namespaces_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        logger.debug(f'Using local vector store at {self.path}')
+
+    def _namespace(self, namespace: str) -> _Namespace:
+        namespace = namespace or 'default'
+        with self._namespaces_lock:
+            store = self._namespaces.get(namespace)
+            if store is None:
+                ann = IVFIndex(**self.ann_params) if namespace in self.ann_namespaces else None
+                store = _Namespace(os.path.join(self.path, namespace), ann)
+                self._namespaces[namespace] = store
+        with store.lock:
+            if store.loaded_version != store.disk_version():
+                with self._lock(store, fcntl.LOCK_SH):
+                    store.load()
+        return store
+
+    def _lock(self, store: _Namespace, mode: int):
+        os.makedirs(store.directory, exist_ok=True)
+        return _FileLock(os.path.join(store.directory, '.lock'), mode)
+
+    def _write(self, namespace: str, apply):
+        store = self._namespace(namespace)
+        with store.lock, self._lock(store, fcntl.LOCK_EX):
+            # Another process may have written between the staleness check and the lock
+            if store.loaded_version != store.disk_version():
+                store.load()
+            apply(store)
+            store.save()
+
+    def upsert_many(self, vectors: List[dict], namespace: str) -> None:
+        # A single locked write, there is no request size to respect locally
+        if vectors:
+            self._upsert_chunk(vectors, namespace)
+
+    def _upsert_chunk(self, vectors: List[dict], namespace: str) -> None:
+        self._write(namespace, lambda store: store.upsert(vectors))
+
+    def delete_many(self, vector_ids: List[str], namespace: str = None) -> None:
+        if vector_ids:
+            self._write(namespace, lambda store: store.delete(vector_ids))
+
+    def add_backlog_item(self, item: BacklogItem, vector: List[float], namespace: str) -> None:
+        logging.debug(f'Adding {item.id} to backlog namespace')
+        self.upsert_many([backlog_item_vector(item, vector)], namespace=namespace)
+
+    def add_code(self, code_base_func: CodeBaseFunction) -> None:
+        logging.debug(f'Adding {code_base_func.id} to codebase namespace')
+        self.upsert_many([code_vector(code_base_func)], namespace='codebase')
+
+    def add_context(self, context_id: str, vector: List[float], context: dict) -> None:
+        logging.debug(f'Adding {context_id} to context namespace')
+        self.upsert_many([{'id': context_id, 'values': vector, 'metadata': context}], namespace='context')
+
+    def delete(self, vector_ids: List[str], namespace: str = None):
+        self.delete_many(vector_ids, namespace=namespace)
+
+    def search(self, query_vector: List[float], num_relevant: int = 5, namespace: str = None):
+        store = self._namespace(namespace)
+        with store.lock:
+            rows, scores = store.query(query_vector, num_relevant)
+            matches = [{'id': store.ids[row],
+                        'score': float(score),
+                        'values': [],
+                        'metadata': store.metadata[row]} for row, score in zip(rows, scores)]
+        return {'matches': matches, 'namespace': namespace or ''}
+
+    def fetch(self, element_id: Any, namespace: Any):
+        return self.fetch_many([element_id], namespace)
+
+    def fetch_many(self, element_ids: List[Any], namespace: Any) -> dict:
+        # Local reads need no chunking either
+        return self._fetch_chunk(element_ids, namespace)
+
+    def _fetch_chunk(self, element_ids: List[Any], namespace: Any) -> dict:
+        store = self._namespace(namespace)
+        vectors = {}
+        with store.lock:
+            for element_id in element_ids:
+                position = store.positions.get(element_id)
+                if position is not None:
+                    vectors[element_id] = {'id': element_id,
+                                           'values': store.matrix[position].tolist(),
+                                           'metadata': store.metadata[position]}
+        return {'vectors': vectors, 'namespace': namespace or ''}
+
+
+class _FileLock:
+
+    def __init__(self, path: str, mode: int):
+        self._path = path
+        self._mode = mode
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, self._mode)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
@@ -1,7 +1,7 @@
 import pinecone
 from typing import List, Any
 from shared_utils.models import BacklogItem, CodeBaseFunction
-from shared_utils.vector_database_base import VectorDatabaseBase
+from shared_utils.vector_database_base import VectorDatabaseBase, backlog_item_vector, code_vector
 import logging
 from shared_utils.logging_config import setup_logging
 
@@ -9,7 +9,7 @@ logger = logging.getLogger(__name__)
 
 
 class PineconeDatabase(VectorDatabaseBase):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, upsert_batch_size: int = 100, max_workers: int = 4):
         pinecone.init(api_key=api_key, environment='asia-northeast1-gcp')
         active_indexes = pinecone.list_indexes()
 
@@ -18,34 +18,25 @@ class PineconeDatabase(VectorDatabaseBase):
             # TODO Remove hardcoded dimension
             self.index = pinecone.create_index('sprintswarm', dimension=1536)
         self.index = pinecone.Index('sprintswarm')
+        self.upsert_batch_size = upsert_batch_size
+        self.max_workers = max_workers
         logger.debug('Connected to sprintswarm index')
 
     def add_backlog_item(self, item: BacklogItem, vector: List[float], namespace: str) -> None:
         logging.debug(f'Adding {item.id} to backlog namespace')
-        self.index.upsert(vectors=[{'id': item.id, 'values': vector, 'metadata':
-                          {'priority': str(item.priority),
-                           'assignee': str(item.assignee),
-                           'status': str(item.status)}}], namespace=namespace)
+        self.index.upsert(vectors=[backlog_item_vector(item, vector)], namespace=namespace)
 
     def add_code(self, code_base_func: CodeBaseFunction) -> None:
         logging.debug(f'Adding {code_base_func.id} to codebase namespace')
-        metadata = {
-            "id": code_base_func.id,
-            "function_name": code_base_func.function_name,
-            "file_path": code_base_func.file_path,
-            "code": code_base_func.code,
-            "description": code_base_func.description
-        }
-        self.index.upsert(vectors=[{'id': code_base_func.id, 'values': code_base_func.embedding,
-                                    'metadata': metadata}], namespace='codebase')
+        self.index.upsert(vectors=[code_vector(code_base_func)], namespace='codebase')
 
     def add_context(self, context_id: str,  vector: List[float],  context: dict) -> None:
         logging.debug(f'Adding {context_id} to codebase namespace')
         self.index.upsert(vectors=[{'id': context_id, 'values': vector,
                                     'metadata': context}], namespace='context')
 
-    def delete(self, vector_ids: List[str]):
-        self.index.delete(vector_ids)
+    def delete(self, vector_ids: List[str], namespace: str = None):
+        self.index.delete(ids=vector_ids, namespace=namespace)
 
     def search(self, query_vector: List[float], num_relevant: int = 5, namespace: str = None):
         return self.index.query(
@@ -54,3 +45,10 @@ class PineconeDatabase(VectorDatabaseBase):
 
     def fetch(self, element_id: Any, namespace: Any):
         return self.index.fetch(ids=[element_id], namespace=namespace)
+
+    def _upsert_chunk(self, vectors: List[dict], namespace: str) -> None:
+        logging.debug(f'Upserting {len(vectors)} vectors to {namespace} namespace')
+        self.index.upsert(vectors=vectors, namespace=namespace)
+
+    def _fetch_chunk(self, element_ids: List[Any], namespace: Any) -> dict:
+        return self.index.fetch(ids=element_ids, namespace=namespace)
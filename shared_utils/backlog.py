@@ -1,40 +1,133 @@
-from shared_utils.PineconeDatabase import PineconeDatabase
+from shared_utils.vector_database import get_vector_database
+from shared_utils.vector_database_base import backlog_item_vector
 from shared_utils.configurations import configurations
 from shared_utils.models import BacklogItem
-from typing import List
-import heapq
+from shared_utils.indexed_heap import IndexedHeap
+from shared_utils.backlog_store import BacklogStore
+from typing import List, Optional
+import copy
+import threading
 import logging
 from shared_utils.logging_config import setup_logging
 
 logger = logging.getLogger(__name__)
 
 
+# Durable store the backlogs are kept in, shared by the worker processes of a service
+backlog_store_path = None
+if configurations.get('backlog_store', 'enabled', default=False):
+    backlog_store_path = configurations.get('backlog_store', 'path', default='./sprintswarm/backlog/backlog.sqlite')
+
+
 class BacklogWithEmbedding:
+    """
+    A priority ordered backlog whose item embeddings are kept in the vector database.
+
+    A backlog with a `name` is kept in the backlog store when it is enabled.  It is loaded
+    from the store on start and each call first catches up on the changes other worker
+    processes made, so the processes of a service share one backlog.  Without a name or a
+    store the backlog lives in this process only.
+    """
+
+    def __init__(self, name: str = None):
+        # Backlog items ordered by priority and indexed by id
+        self._backlog = IndexedHeap(key=lambda item: item.id)
+        self._vector_db = get_vector_database()
+        self._lock = threading.RLock()
+        self._store = None
+        self._seq = 0
+        if name is not None and backlog_store_path is not None:
+            self._store = BacklogStore(backlog_store_path, name)
+            self._reload()
+
+    def _reload(self):
+        items, self._seq = self._store.load()
+        self._backlog = IndexedHeap(items, key=lambda item: item.id)
+        logger.info(f'Loaded {len(items)} items of the {self._store.name} backlog')
+
+    def _apply(self, changes):
+        if changes is None:
+            self._reload()
+            return
+        for item_id, item in changes.items():
+            if item is None:
+                self._backlog.remove(item_id)
+            else:
+                self._backlog.push(item)
 
-    def __init__(self):
-        self._backlog = []
-        self._vector_db = PineconeDatabase(configurations.get('pinecone', 'api_key'))
+    def _sync(self):
+        if self._store is not None:
+            changes, self._seq = self._store.changes(self._seq)
+            self._apply(changes)
+
+    def _save(self, items: List[BacklogItem] = (), deleted_ids: List[str] = ()):
+        if self._store is not None:
+            changes, self._seq = self._store.write(self._seq, items, deleted_ids)
+            self._apply(changes)
 
     def add_item(self, item: BacklogItem, embedding: list, namespace: str):
         logging.info('Adding backlog item')
-        heapq.heappush(self._backlog, item)
+        with self._lock:
+            self._save([item])
+            self._backlog.push(item)
         self._vector_db.add_backlog_item(item, embedding, namespace=namespace)
 
-    def delete_item(self, item_id: List[str]):
-        self._backlog = [item for item in self._backlog if item.item.id != item_id]
-        heapq.heapify(self._backlog)
-        self._vector_db.delete(item_id)
+    def add_items(self, items: List[BacklogItem], embeddings: List[list], namespace: str):
+        logging.info(f'Adding {len(items)} backlog items')
+        with self._lock:
+            self._save(items)
+            self._backlog.extend(items)
+        self._vector_db.upsert_many([backlog_item_vector(item, embedding)
+                                     for item, embedding in zip(items, embeddings)], namespace=namespace)
+
+    def get_item(self, item_id: str) -> Optional[BacklogItem]:
+        with self._lock:
+            self._sync()
+            return self._backlog.get(item_id)
+
+    def delete_item(self, item_id: str, namespace: str = None):
+        self.delete_items([item_id], namespace=namespace)
 
-    def update_priority(self, item_id: int, new_priority: int):
-        for item in self._backlog:
-            if item.item.id == item_id:
+    def delete_items(self, item_ids: List[str], namespace: str = None):
+        item_ids = list(item_ids)
+        with self._lock:
+            self._save(deleted_ids=item_ids)
+            for item_id in item_ids:
+                self._backlog.remove(item_id)
+        self._vector_db.delete_many(item_ids, namespace=namespace)
+
+    def update_priority(self, item_id: str, new_priority: int):
+        with self._lock:
+            self._sync()
+            item = self._backlog.get(item_id)
+            if item is not None:
+                # Change a copy, the heap keeps the old item in place if saving fails
+                item = copy.copy(item)
                 item.priority = new_priority
-                heapq.heapify(self._backlog)
-                break
+                self._save([item])
+                self._backlog.push(item)
 
     def search_items(self, query_embedding: list, num_results: int, namespace: str):
-        item_ids = self._vector_db.search(query_embedding, num_results, namespace=namespace)
-        return [item for item in self._backlog if item.item.id in item_ids]
+        results = self._vector_db.search(query_embedding, num_results, namespace=namespace)
+        with self._lock:
+            self._sync()
+            # Most relevant first, skipping matches that are no longer in the backlog
+            return [self._backlog.get(match['id']) for match in results['matches'] if match['id'] in self._backlog]
+
+    def top_items(self, number_of_items: int) -> List[BacklogItem]:
+        """The highest priority items, lowest priority value first."""
+        with self._lock:
+            self._sync()
+            return self._backlog.top_k(number_of_items)
+
+    def pop_item(self) -> BacklogItem:
+        with self._lock:
+            self._sync()
+            item = self._backlog.peek()
+            self._save(deleted_ids=[item.id])
+            return self._backlog.remove(item.id)
 
-    def get_backlog(self):
-        return self._backlog
+    def get_backlog(self) -> List[BacklogItem]:
+        with self._lock:
+            self._sync()
+            return list(self._backlog)
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+from shared_utils.models import BacklogItem
+from shared_utils.sqlite import ThreadConnections, chunks
+
+logger = logging.getLogger(__name__)
+
+
+class BacklogStore:
+    """
+    Backlog items of named backlogs in a SQLite file that the worker processes of a service,
+    and its restarts, share.
+
+    Every write also appends the changed ids to a change log.  A process keeps the sequence
+    number of the last change it has seen and catches up on the changes made by other
+    processes with `changes`, without reloading the whole backlog.  Writes happen in one
+    immediate transaction that first returns the changes the writer had not seen yet, so no
+    change can slip in between catching up and writing.  The database runs in WAL mode so
+    readers never block on a writer.  Only the items are stored, their embeddings stay in the
+    vector database.
+    """
+
+    def __init__(self, path: str, name: str, max_changes: int = 100000):
+        self.path = path
+        self.name = name
+        self.max_changes = max_changes
+        self._connections = ThreadConnections(path, isolation_level=None)
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS backlog_items '
+                               '(name TEXT NOT NULL, id TEXT NOT NULL, priority INTEGER NOT NULL, '
+                               'item TEXT NOT NULL, status INTEGER NOT NULL, assignee TEXT, '
+                               'PRIMARY KEY (name, id))')
+            connection.execute('CREATE TABLE IF NOT EXISTS backlog_changes '
+                               '(seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, id TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS backlog_changes_name ON backlog_changes (name, seq)')
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def _to_row(item: BacklogItem) -> tuple:
+        return item.id, item.priority, json.dumps(item.item), item.status, \
+            None if item.assignee is None else str(item.assignee)
+
+    @staticmethod
+    def _from_row(item_id: str, priority: int, item: str, status: int, assignee: Optional[str]) -> BacklogItem:
+        backlog_item = BacklogItem(priority=priority, item=json.loads(item))
+        # Keep the stored id, str hashes and so the ids BacklogItem derives differ between processes
+        backlog_item.id = item_id
+        backlog_item.status = status
+        backlog_item.assignee = assignee
+        return backlog_item
+
+    def _last_seq(self, connection: sqlite3.Connection) -> int:
+        return connection.execute('SELECT COALESCE(MAX(seq), 0) FROM backlog_changes').fetchone()[0]
+
+    def load(self) -> Tuple[List[BacklogItem], int]:
+        """All items of the backlog and the sequence number they are current as of."""
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            seq = self._last_seq(connection)
+            rows = connection.execute('SELECT id, priority, item, status, assignee FROM backlog_items '
+                                      'WHERE name = ?', (self.name,)).fetchall()
+        finally:
+            connection.execute('COMMIT')
+        return [self._from_row(*row) for row in rows], seq
+
+    def changes(self, since: int) -> Tuple[Optional[Dict[str, Optional[BacklogItem]]], int]:
+        """
+        The items changed after sequence number `since`, None for deleted ones, and the new
+        sequence number.  Returns None for the changes when the log no longer reaches back to
+        `since`, the caller has to load the backlog again.
+        """
+        connection = self._connection()
+        if self._last_seq(connection) == since:
+            return {}, since
+        connection.execute('BEGIN')
+        try:
+            changes, seq = self._read_changes(connection, since)
+        finally:
+            connection.execute('COMMIT')
+        return changes, seq
+
+    def _read_changes(self, connection: sqlite3.Connection, since: int):
+        seq = self._last_seq(connection)
+        if seq == since:
+            return {}, seq
+        oldest = connection.execute('SELECT MIN(seq) FROM backlog_changes').fetchone()[0]
+        if oldest is None or oldest > since + 1:
+            return None, seq
+
+        changed_ids = [row[0] for row in connection.execute(
+            'SELECT DISTINCT id FROM backlog_changes WHERE name = ? AND seq > ?', (self.name, since))]
+        changes = dict.fromkeys(changed_ids)
+        for chunk, placeholders in chunks(changed_ids):
+            rows = connection.execute(f'SELECT id, priority, item, status, assignee FROM backlog_items '
+                                      f'WHERE name = ? AND id IN ({placeholders})', [self.name, *chunk])
+            for row in rows:
+                changes[row[0]] = self._from_row(*row)
+        return changes, seq
+
+    def write(self, since: int, items: Iterable[BacklogItem] = (),
+              deleted_ids: Iterable[str] = ()) -> Tuple[Optional[Dict[str, Optional[BacklogItem]]], int]:
+        """
+        Saves `items` and deletes `deleted_ids`.  Returns the changes other processes made
+        after `since`, as `changes` does, and the sequence number including this write.
+        """
+        rows = [self._to_row(item) for item in items]
+        deleted_ids = list(deleted_ids)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            changes, _ = self._read_changes(connection, since)
+            connection.executemany('INSERT OR REPLACE INTO backlog_items (name, id, priority, item, status, assignee) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', [(self.name, *row) for row in rows])
+            connection.executemany('DELETE FROM backlog_items WHERE name = ? AND id = ?',
+                                   [(self.name, item_id) for item_id in deleted_ids])
+            connection.executemany('INSERT INTO backlog_changes (name, id) VALUES (?, ?)',
+                                   [(self.name, item_id) for item_id in [row[0] for row in rows] + deleted_ids])
+            seq = self._last_seq(connection)
+            # Trim the log, processes that fall further behind reload the backlog
+            connection.execute('DELETE FROM backlog_changes WHERE seq <= ?', (seq - self.max_changes,))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return changes, seq
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, List, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects single items submitted from any thread and hands them to `process_batch` together.
+
+    The first item of a batch waits at most `max_wait_ms` for company, a batch is flushed early
+    once it holds `max_batch_size` items.  `process_batch` receives a list of items and must
+    return a list of results in the same order.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 256, max_wait_ms: float = 5):
+        self._process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                    self._worker.start()
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Skips the items whose caller gave up while they were queued, the others can no
+            # longer be cancelled
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = self._process_batch(items)
+                if len(results) != len(items):
+                    raise ValueError(f'Batch of {len(items)} returned {len(results)} results')
+            except Exception as e:
+                logger.error(f'Batch of {len(items)} failed: {e}')
+                for _, future in batch:
+                    _settle(future, exception=e)
+                continue
+            for (_, future), result in zip(batch, results):
+                _settle(future, result)
+
+
+def _settle(future: Future, result: Any = None, exception: BaseException = None) -> None:
+    # The worker thread serves every later batch, so a future that cannot take its outcome
+    # must not end it
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        logger.warning('Dropped the outcome of a batched item that was already resolved')
@@ -0,0 +1,102 @@
+import sqlite3
+import time
+from typing import Dict, List, Optional
+import logging
+from shared_utils import metrics
+from shared_utils.sqlite import ThreadConnections, chunks
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """
+    Key/value cache in a SQLite file that any number of processes on the host can share.
+
+    The database runs in WAL mode so readers never block on a writer.  Each hit refreshes the
+    entry's access time.  Every time a process has added a twentieth of `max_entries` it
+    checks the size and, above `max_entries`, evicts the least recently used rows.  With
+    `ttl_seconds` set, entries older than that are treated as misses and removed.  Hits and
+    misses are counted on /metrics as cache_hits_total and cache_misses_total, labelled with
+    the table.
+    """
+
+    def __init__(self, path: str, table: str = 'cache', max_entries: int = 100000, ttl_seconds: float = None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._connections = ThreadConnections(path)
+        # Counting the rows scans the table, so the size is only checked every so many inserts.
+        # The first insert checks, the file may have filled up before this process started.
+        self._check_every = max(1, max_entries // 20)
+        self._added = self._check_every
+
+        with self._connection() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                               f'(key TEXT PRIMARY KEY, value BLOB NOT NULL, last_access REAL NOT NULL, '
+                               f'created REAL NOT NULL DEFAULT 0)')
+            columns = [row[1] for row in connection.execute(f'PRAGMA table_info({self.table})')]
+            if 'created' not in columns:
+                connection.execute(f'ALTER TABLE {self.table} ADD COLUMN created REAL NOT NULL DEFAULT 0')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_last_access '
+                               f'ON {self.table} (last_access)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_created ON {self.table} (created)')
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        expired = []
+        oldest = time.time() - self.ttl_seconds if self.ttl_seconds else None
+        connection = self._connection()
+        for chunk, placeholders in chunks(keys):
+            rows = connection.execute(f'SELECT key, value, created FROM {self.table} WHERE key IN ({placeholders})',
+                                      chunk).fetchall()
+            for key, value, created in rows:
+                if oldest is not None and created < oldest:
+                    expired.append(key)
+                else:
+                    found[key] = value
+
+        if found or expired:
+            with connection:
+                connection.executemany(f'UPDATE {self.table} SET last_access = ? WHERE key = ?',
+                                       [(time.time(), key) for key in found])
+                connection.executemany(f'DELETE FROM {self.table} WHERE key = ?', [(key,) for key in expired])
+        metrics.cache_hits.inc(len(found), cache=self.table)
+        metrics.cache_misses.inc(len(keys) - len(found), cache=self.table)
+        return found
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        if not items:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(f'INSERT OR REPLACE INTO {self.table} (key, value, last_access, created) '
+                                   f'VALUES (?, ?, ?, ?)',
+                                   [(key, value, now, now) for key, value in items.items()])
+            self._added += len(items)
+            if self._added >= self._check_every:
+                self._added = 0
+                self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        if self.ttl_seconds:
+            connection.execute(f'DELETE FROM {self.table} WHERE created < ?', (time.time() - self.ttl_seconds,))
+        size = connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        if size > self.max_entries:
+            # Evict down to 90% so eviction does not run on every insert once the cache is full
+            excess = size - int(self.max_entries * 0.9)
+            connection.execute(f'DELETE FROM {self.table} WHERE key IN '
+                               f'(SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)', (excess,))
+            logger.debug(f'Evicted {excess} entries from {self.table} cache')
+
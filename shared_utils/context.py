@@ -1,38 +1,155 @@
-from shared_utils.PineconeDatabase import PineconeDatabase
+from shared_utils.vector_database import get_vector_database
 from shared_utils.configurations import configurations
-from shared_utils.nlp import generate_embedding
+from shared_utils.nlp import agenerate_embeddings, generate_embedding, generate_embeddings
 from shared_utils.models import BacklogItem, ProductVision, ProjectStructure
 from typing import List
+import asyncio
+import contextvars
 import heapq
 import json
+import threading
+import time
+import uuid
 import logging
 from shared_utils.logging_config import setup_logging
 
 logger = logging.getLogger(__name__)
 
 
+# How long a process trusts its cached project context before checking the version stamps again.
+# With 0 every read checks the stamps, a project written by another process is seen right away.
+# Larger values save that fetch but serve the previous project for up to this long.
+refresh_seconds = configurations.get('context', 'refresh_seconds', default=0)
+
+VERSION_KEY = 'context_version'
+
+
+def _new_version() -> str:
+    return uuid.uuid4().hex
+
+
+class _ContextCache:
+    """
+    The project vision and structure last read by this process, shared by its Context
+    instances.  Each stored context entry carries a version stamp.  A read fetches both
+    entries, compares the stamps and only parses the structure again when a stamp changed.
+    Within refresh_seconds, 0 by default, the cached values are used without that fetch, so
+    a write by another process may go unseen for that long.  Writes made by this process
+    replace the cache right away.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.versions = None
+        self.vision = None
+        self.structure = None
+        self.entry = None
+        self.checked_at = 0.0
+
+    def set(self, versions: tuple, vision: dict, structure: dict):
+        self.versions = versions
+        self.vision = vision
+        self.structure = structure
+        self.entry = (vision, structure)
+        self.checked_at = time.monotonic()
+
+    def fresh(self) -> bool:
+        return self.versions is not None and time.monotonic() - self.checked_at < refresh_seconds
+
+    def fresh_entry(self):
+        """The cached (vision, structure) while fresh, else None.  Read without the lock."""
+        entry = self.entry
+        return entry if entry is not None and self.fresh() else None
+
+
+_cache = _ContextCache()
+
+
 class Context:
 
     def __init__(self):
-        self._vector_db = PineconeDatabase(configurations.get('pinecone', 'api_key'))
+        self._vector_db = get_vector_database()
 
     def add_project_vision(self, vision: ProductVision):
         # Add the project vision to the vector database
-        vector = generate_embedding(vision.title)
-        self._vector_db.add_context('vision_context', vector, vision.__dict__)
+        vector = generate_embedding(vision.title, call_site='project_context')
+        self._vector_db.add_context('vision_context', vector, {**vision.__dict__, VERSION_KEY: _new_version()})
+        with _cache.lock:
+            _cache.clear()
 
     def get_project_vision(self):
-        # Retrieve the project vision from the vector database
-        vision = self._vector_db.fetch('vision_context', 'context')['vectors']['vision_context']['metadata']
-        return vision
+        # Retrieve the project vision from the cache or the vector database
+        return self.get_project_context()[0]
 
     def add_project_structure(self, project_structure: str):
         # Add the project structure to the vector database
-        vector = generate_embedding(project_structure)
-        self._vector_db.add_context('structure_context', vector, {'project_structure': project_structure})
+        vector = generate_embedding(project_structure, call_site='project_context')
+        self._vector_db.add_context('structure_context', vector,
+                                    {'project_structure': project_structure, VERSION_KEY: _new_version()})
+        with _cache.lock:
+            _cache.clear()
 
     def get_project_structure(self):
-        # Retrieve the project structure from the vector database
-        project_structure = self._vector_db.fetch(
-            'structure_context', 'context')['vectors']['structure_context']['metadata']['project_structure']
-        return json.loads(project_structure)
+        # Retrieve the project structure from the cache or the vector database
+        return self.get_project_context()[1]
+
+    def add_project_context(self, vision: ProductVision, project_structure: str):
+        # Add the project vision and structure to the vector database in one upsert
+        vision_vector, structure_vector = generate_embeddings([vision.title, project_structure],
+                                                              call_site='project_context')
+        self._store_project_context(vision, project_structure, vision_vector, structure_vector)
+
+    async def aadd_project_context(self, vision: ProductVision, project_structure: str):
+        """Async version of add_project_context, the upsert runs on a worker thread."""
+        vision_vector, structure_vector = await agenerate_embeddings([vision.title, project_structure],
+                                                                     call_site='project_context')
+        await asyncio.to_thread(self._store_project_context, vision, project_structure, vision_vector,
+                                structure_vector)
+
+    def _store_project_context(self, vision: ProductVision, project_structure: str, vision_vector: List[float],
+                               structure_vector: List[float]):
+        versions = (_new_version(), _new_version())
+        vectors = [
+            {'id': 'vision_context', 'values': vision_vector,
+             'metadata': {**vision.__dict__, VERSION_KEY: versions[0]}},
+            {'id': 'structure_context', 'values': structure_vector,
+             'metadata': {'project_structure': project_structure, VERSION_KEY: versions[1]}},
+        ]
+        self._vector_db.upsert_many(vectors, 'context')
+        with _cache.lock:
+            _cache.set(versions, dict(vision.__dict__), json.loads(project_structure))
+
+    def get_project_context(self):
+        """
+        The project vision and structure.  Served from the process cache while it is fresh,
+        otherwise both are fetched from the vector database in one call.
+        """
+        with _cache.lock:
+            if _cache.fresh():
+                return _cache.vision, _cache.structure
+
+            vectors = self._vector_db.fetch_many(['vision_context', 'structure_context'], 'context')['vectors']
+            vision = dict(vectors['vision_context']['metadata'])
+            structure_metadata = vectors['structure_context']['metadata']
+            versions = (vision.pop(VERSION_KEY, None), structure_metadata.get(VERSION_KEY))
+            if versions == _cache.versions and None not in versions:
+                # Unchanged, keep the parsed structure
+                _cache.checked_at = time.monotonic()
+            else:
+                _cache.set(versions, vision, json.loads(structure_metadata['project_structure']))
+            return _cache.vision, _cache.structure
+
+    async def aget_project_context(self):
+        """
+        Async version of get_project_context for request handlers.  A fresh cache is served
+        right away, a refresh runs on a worker thread so neither the fetch nor waiting for the
+        cache lock blocks the event loop.
+        """
+        entry = _cache.fresh_entry()
+        if entry is not None:
+            return entry
+        return await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run,
+                                                                 self.get_project_context)
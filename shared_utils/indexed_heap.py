@@ -0,0 +1,134 @@
+import heapq
+from typing import Any, Callable, Hashable, Iterable, Iterator, List
+
+
+class IndexedHeap:
+    """
+    Binary min-heap with a map from each item's key to its position in the heap.
+
+    Items are ordered by their own comparison (BacklogItem compares by priority) and keyed by
+    `key`, so an item can be found in O(1) and removed or re-positioned in O(log n) without
+    scanning the heap.  Pushing an item whose key is already present replaces that item.
+    """
+
+    def __init__(self, items: Iterable[Any] = (), key: Callable[[Any], Hashable] = lambda item: item.id):
+        self._key = key
+        self._heap = []
+        self._positions = {}
+        self.extend(items)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __contains__(self, item_key: Hashable) -> bool:
+        return item_key in self._positions
+
+    def __iter__(self) -> Iterator[Any]:
+        """Iterates in heap order, use top_k for priority order."""
+        return iter(self._heap)
+
+    def get(self, item_key: Hashable, default: Any = None) -> Any:
+        position = self._positions.get(item_key)
+        return default if position is None else self._heap[position]
+
+    def peek(self) -> Any:
+        return self._heap[0]
+
+    def push(self, item: Any) -> None:
+        item_key = self._key(item)
+        position = self._positions.get(item_key)
+        if position is not None:
+            self._heap[position] = item
+            self._restore(position)
+            return
+        self._heap.append(item)
+        self._positions[item_key] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def extend(self, items: Iterable[Any]) -> None:
+        # The last of several items with the same key wins, as with push
+        items = list({self._key(item): item for item in items}.values())
+        # Pushing costs O(k log n), re-heapifying everything O(n + k)
+        if len(items) < len(self._heap) // 4 or any(self._key(item) in self._positions for item in items):
+            for item in items:
+                self.push(item)
+            return
+        self._heap.extend(items)
+        heapq.heapify(self._heap)
+        self._positions = {self._key(item): position for position, item in enumerate(self._heap)}
+
+    def pop(self) -> Any:
+        return self._remove_at(0)
+
+    def remove(self, item_key: Hashable) -> Any:
+        """Removes and returns the item with the key, None if there is none."""
+        position = self._positions.get(item_key)
+        if position is None:
+            return None
+        return self._remove_at(position)
+
+    def reorder(self, item_key: Hashable) -> None:
+        """Restores the heap after the sort order of the item with the key was changed in place."""
+        self._restore(self._positions[item_key])
+
+    def top_k(self, k: int) -> List[Any]:
+        """
+        The k smallest items in order, in O(k log k).  The heap is walked from the root with a
+        frontier of the candidates, so the heap is neither copied nor modified.
+        """
+        result = []
+        if not self._heap or k <= 0:
+            return result
+        frontier = [(self._heap[0], 0)]
+        while frontier and len(result) < k:
+            item, position = heapq.heappop(frontier)
+            result.append(item)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return result
+
+    def _remove_at(self, position: int) -> Any:
+        item = self._heap[position]
+        del self._positions[self._key(item)]
+        last = self._heap.pop()
+        if position < len(self._heap):
+            self._heap[position] = last
+            self._positions[self._key(last)] = position
+            self._restore(position)
+        return item
+
+    def _restore(self, position: int) -> None:
+        if position > 0 and self._heap[position] < self._heap[(position - 1) // 2]:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def _move(self, item: Any, position: int) -> None:
+        self._heap[position] = item
+        self._positions[self._key(item)] = position
+
+    def _sift_up(self, position: int) -> None:
+        item = self._heap[position]
+        while position > 0:
+            parent = (position - 1) // 2
+            if not item < self._heap[parent]:
+                break
+            self._move(self._heap[parent], position)
+            position = parent
+        self._move(item, position)
+
+    def _sift_down(self, position: int) -> None:
+        item = self._heap[position]
+        size = len(self._heap)
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and self._heap[child + 1] < self._heap[child]:
+                child += 1
+            if not self._heap[child] < item:
+                break
+            self._move(self._heap[child], position)
+            position = child
+        self._move(item, position)
@@ -0,0 +1,230 @@
+import json
+import os
+import numpy as np
+from typing import List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate cosine search over unit-length vectors.
+
+    Vectors are assigned to the nearest of `nlist` coarse centroids (spherical k-means) and a
+    query only scores the vectors in its `nprobe` closest lists.  Raising nprobe trades speed
+    for recall, nprobe == nlist is an exact search.  Until `train_threshold` vectors have been
+    added the index keeps a single list, i.e. it is a flat exact index.
+    """
+
+    def __init__(self, nlist: int = 64, nprobe: int = 8, train_threshold: int = None,
+                 retrain_factor: float = 4.0, kmeans_iterations: int = 20, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_threshold = train_threshold or nlist * 39
+        self.retrain_factor = retrain_factor
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = [_InvertedList()]
+        self._where = {}
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def __len__(self):
+        return len(self._where)
+
+    def add(self, ids: List[str], vectors: np.ndarray) -> None:
+        """Inserts or replaces vectors.  `vectors` must already be normalised."""
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(set(ids)) != len(ids):
+            # Keep the last vector given for a repeated id
+            last = {vector_id: i for i, vector_id in enumerate(ids)}
+            ids = list(last)
+            vectors = vectors[list(last.values())]
+        self.remove([vector_id for vector_id in ids if vector_id in self._where])
+
+        if not self.trained and len(self) + len(ids) >= self.train_threshold:
+            self._train(ids, vectors)
+            return
+        if self.trained and len(self) + len(ids) > self.retrain_factor * self.trained_size:
+            self._train(ids, vectors)
+            return
+
+        for list_number, vector_id, vector in zip(self._assign(vectors), ids, vectors):
+            position = self._lists[list_number].append(vector_id, vector)
+            self._where[vector_id] = (list_number, position)
+
+    def remove(self, ids: List[str]) -> None:
+        for vector_id in ids:
+            location = self._where.pop(vector_id, None)
+            if location is None:
+                continue
+            list_number, position = location
+            moved_id = self._lists[list_number].remove(position)
+            if moved_id is not None:
+                self._where[moved_id] = (list_number, position)
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: int = None) -> Tuple[List[str], np.ndarray]:
+        """Returns the ids and cosine scores of the approximate top_k neighbours of a normalised query."""
+        if len(self) == 0 or top_k < 1:
+            return [], np.zeros(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+
+        if self.trained:
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            centroid_scores = self.centroids @ query
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            probes = [0]
+
+        candidate_ids = []
+        candidate_scores = []
+        for list_number in probes:
+            inverted_list = self._lists[list_number]
+            if inverted_list.size:
+                candidate_ids.extend(inverted_list.ids)
+                candidate_scores.append(inverted_list.vectors[:inverted_list.size] @ query)
+        if not candidate_ids:
+            return [], np.zeros(0, dtype=np.float32)
+
+        scores = np.concatenate(candidate_scores)
+        top_k = min(top_k, len(scores))
+        if top_k < len(scores):
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [candidate_ids[i] for i in best], scores[best]
+
+    def save(self, path: str) -> None:
+        """Persists the centroids and list assignments, the vectors themselves are stored by the caller."""
+        assignments = {vector_id: int(list_number) for vector_id, (list_number, _) in self._where.items()}
+        centroids = self.centroids if self.trained else np.zeros((0, 0), dtype=np.float32)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=centroids,
+                     state=np.frombuffer(json.dumps({'assignments': assignments,
+                                                     'trained_size': self.trained_size}).encode(),
+                                         dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    def load(self, path: str, ids: List[str], vectors: np.ndarray) -> None:
+        """Rebuilds the index from a saved state and the vectors it was built over."""
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = [_InvertedList()]
+        self._where = {}
+        if not os.path.exists(path):
+            self.add(ids, vectors)
+            return
+
+        with np.load(path) as saved:
+            centroids = saved['centroids']
+            state = json.loads(saved['state'].tobytes().decode())
+        if centroids.size:
+            self.centroids = centroids
+            self.trained_size = state['trained_size']
+            self._lists = [_InvertedList() for _ in range(len(centroids))]
+
+        assignments = state['assignments']
+        missing = []
+        for vector_id, vector in zip(ids, vectors):
+            list_number = assignments.get(vector_id)
+            if list_number is None or list_number >= len(self._lists):
+                missing.append((vector_id, vector))
+                continue
+            position = self._lists[list_number].append(vector_id, vector)
+            self._where[vector_id] = (list_number, position)
+        if missing:
+            self.add([vector_id for vector_id, _ in missing], np.asarray([vector for _, vector in missing]))
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        if not self.trained:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _train(self, new_ids: List[str], new_vectors: np.ndarray) -> None:
+        ids = list(new_ids)
+        blocks = [new_vectors]
+        for inverted_list in self._lists:
+            ids.extend(inverted_list.ids)
+            blocks.append(inverted_list.vectors[:inverted_list.size])
+        vectors = np.concatenate([block for block in blocks if len(block)])
+
+        nlist = min(self.nlist, len(vectors))
+        logger.debug(f'Training IVF index with {nlist} lists over {len(vectors)} vectors')
+        self.centroids = _spherical_kmeans(vectors, nlist, self.kmeans_iterations, self.seed)
+        self.trained_size = len(vectors)
+        self._lists = [_InvertedList() for _ in range(nlist)]
+        self._where = {}
+        assignments = self._assign(vectors)
+        for list_number in range(nlist):
+            members = np.flatnonzero(assignments == list_number)
+            if len(members):
+                self._lists[list_number].extend([ids[i] for i in members], vectors[members])
+                for position, i in enumerate(members):
+                    self._where[ids[i]] = (list_number, position)
+
+
+class _InvertedList:
+
+    def __init__(self):
+        self.ids = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+
+    def append(self, vector_id: str, vector: np.ndarray) -> int:
+        self.extend([vector_id], vector[np.newaxis])
+        return self.size - 1
+
+    def extend(self, ids: List[str], vectors: np.ndarray) -> None:
+        needed = self.size + len(ids)
+        if needed > self.vectors.shape[0]:
+            grown = np.zeros((max(needed, 2 * self.size, 16), vectors.shape[1]), dtype=np.float32)
+            if self.size:
+                grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+        self.vectors[self.size:needed] = vectors
+        self.ids.extend(ids)
+        self.size = needed
+
+    def remove(self, position: int):
+        """Swap-removes a row and returns the id that moved into `position`, if any."""
+        last = self.size - 1
+        moved_id = None
+        if position != last:
+            self.vectors[position] = self.vectors[last]
+            self.ids[position] = self.ids[last]
+            moved_id = self.ids[position]
+        self.ids.pop()
+        self.size -= 1
+        return moved_id
+
+
+def _spherical_kmeans(vectors: np.ndarray, k: int, iterations: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    # Training on a sample keeps retraining cheap, 256 points per centroid is plenty
+    if len(vectors) > k * 256:
+        vectors = vectors[rng.choice(len(vectors), k * 256, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+
+        empty = counts == 0
+        if empty.any():
+            # Re-seed empty clusters with random points so every list stays useful
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
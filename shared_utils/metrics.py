@@ -0,0 +1,119 @@
+import bisect
+import threading
+from typing import Dict, Sequence, Tuple
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+# Name of the service this process runs, added to every sample as the `service` label
+service_name = 'unknown'
+
+# Latency buckets in seconds, LLM calls take from a fraction of a second to minutes
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = ('service', *labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: dict) -> Tuple:
+        return (service_name, *(labels[name] for name in self.label_names[1:]))
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return '\n'.join(lines)
+
+    def _samples(self, key: Tuple, value) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self.label_names, key)} {value}']
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, f'le="{bound}"')
+            samples.append(f'{self.name}_bucket{labels} {cumulative}')
+        samples.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+        samples.append(f'{self.name}_count{_format_labels(self.label_names, key)} {cumulative}')
+        return samples
+
+
+_LLM_LABELS = ('model', 'call_site')
+
+llm_requests = Counter('llm_requests_total', 'LLM API requests.', _LLM_LABELS)
+llm_errors = Counter('llm_errors_total', 'LLM API requests that failed.', _LLM_LABELS)
+llm_prompt_tokens = Counter('llm_prompt_tokens_total', 'Prompt tokens sent to the LLM API.', _LLM_LABELS)
+llm_completion_tokens = Counter('llm_completion_tokens_total', 'Completion tokens returned by the LLM API.',
+                                _LLM_LABELS)
+llm_cost = Counter('llm_cost_dollars_total', 'Estimated LLM API cost in US dollars.', _LLM_LABELS)
+llm_latency = Histogram('llm_request_duration_seconds', 'LLM API request latency.', _LLM_LABELS)
+llm_cache_hits = Counter('llm_cache_hits_total', 'LLM requests answered from the completion or embedding cache.',
+                         _LLM_LABELS)
+cache_hits = Counter('cache_hits_total', 'Keys found in a disk cache.', ('cache',))
+cache_misses = Counter('cache_misses_total', 'Keys looked up in a disk cache and not found.', ('cache',))
+
+REGISTRY = [llm_requests, llm_errors, llm_prompt_tokens, llm_completion_tokens, llm_cost, llm_latency,
+            llm_cache_hits, cache_hits, cache_misses]
+
+
+def render_metrics() -> str:
+    """All metrics of this process in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def install_metrics(app: FastAPI, service: str) -> None:
+    """Labels this process' metrics with the service name and serves them on /metrics."""
+    global service_name
+    service_name = service
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def metrics():
+        return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
@@ -36,6 +36,38 @@ class CodeBaseFunction(BaseModel):
     code: str
     embedding: List[float]
     description: str
+    kind: Optional[str] = None
+    start_line: Optional[int] = None
+    end_line: Optional[int] = None
+
+
+class CodeSearchMatch(BaseModel):
+    id: str
+    score: float
+    file_path: str
+    function_name: str
+    description: str
+    code: Optional[str] = None  # Only when include_code is requested
+
+
+class CodeSearchResults(BaseModel):
+    matches: List[CodeSearchMatch]
+    namespace: str
+    index_state: str
+
+
+class CodeSearchResponse(BaseModel):
+    results: CodeSearchResults
+
+
+class CodeSearchBatchResponse(BaseModel):
+    results: List[CodeSearchResults]  # In the order of the queries
+
+
+class CodeSearchRequest(BaseModel):
+    queries: List[str]
+    top_k: int = 5
+    include_code: bool = False
 
 
 class WorkItemUpdate(BaseModel):
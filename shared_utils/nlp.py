@@ -1,31 +1,217 @@
 import openai
-import ast
-from shared_utils.configurations import configurations
+import asyncio
+import hashlib
+import json
 import re
+import time
+from array import array
+from typing import Callable, List
+from weakref import WeakKeyDictionary
+from shared_utils.batching import MicroBatcher
+from shared_utils.cache import DiskCache
+from shared_utils.configurations import configurations
+from shared_utils import metrics
+from shared_utils.output_parser import StructuredOutputParser, extract_structure, parse_structures
+from shared_utils.tracing import span
 
 openai.api_key = configurations.get('openai', 'api_key')
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+embedding_batch_size = configurations.get('openai', 'embedding_batch_size', default=512)
+embedding_batch_wait_ms = configurations.get('openai', 'embedding_batch_wait_ms', default=5)
+# Requests the async clients keep in flight at once, per process
+max_concurrent_requests = configurations.get('openai', 'max_concurrent_requests', default=32)
+# Dollars per 1000 prompt and completion tokens, by model, for the cost metric
+prices = configurations.get('openai', 'prices', default={})
+
+# Embeddings keyed by model and text hash, shared by every service on the host.  The async
+# functions read and write both caches on worker threads, off the event loop.
+embedding_cache = None
+if configurations.get('embedding_cache', 'enabled', default=False):
+    embedding_cache = DiskCache(configurations.get('embedding_cache', 'path',
+                                                   default='./sprintswarm/cache/embeddings.sqlite'),
+                                table='embeddings',
+                                max_entries=configurations.get('embedding_cache', 'max_entries', default=200000))
+
+# Completion cache policies, chosen per call site
+CACHE_NEVER = 'never'
+CACHE_ALWAYS = 'always'
+CACHE_DETERMINISTIC = 'deterministic'
+
+# Opt-in cache of completion responses keyed by the full request
+completion_cache = None
+if configurations.get('completion_cache', 'enabled', default=False):
+    completion_cache = DiskCache(configurations.get('completion_cache', 'path',
+                                                    default='./sprintswarm/cache/completions.sqlite'),
+                                 table='completions',
+                                 max_entries=configurations.get('completion_cache', 'max_entries', default=50000),
+                                 ttl_seconds=configurations.get('completion_cache', 'ttl_seconds', default=604800))
+
+
+# Words, numbers and single punctuation marks, roughly how the OpenAI tokenizers split text
+_TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+
 
-def generate_completion(prompt, max_tokens=50, temperature=0.8):
+def estimate_tokens(text: str) -> int:
+    """
+    Local estimate of the number of tokens in the text.  Long words are split into several
+    tokens, so the estimate errs on the high side for code and paths.
+    """
+    return sum(1 + len(piece) // 8 for piece in _TOKEN_PATTERN.findall(text))
+
+
+def _completion_key(**request) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _should_cache(cache_policy: str, temperature: float) -> bool:
+    if completion_cache is None or cache_policy == CACHE_NEVER:
+        return False
+    if cache_policy == CACHE_ALWAYS:
+        return True
+    if cache_policy == CACHE_DETERMINISTIC:
+        return temperature == 0
+    raise ValueError(f'Unknown cache policy: {cache_policy}')
+
+
+def _cache_key(cache_policy: str, request: dict):
+    """The completion cache key of a request, None when the request is not cached."""
+    if not _should_cache(cache_policy, request['temperature']):
+        return None
+    return _completion_key(**request)
+
+
+_semaphores = WeakKeyDictionary()
+
+
+def _request_slot() -> asyncio.Semaphore:
+    """
+    The semaphore limiting the async clients to max_concurrent_requests.  asyncio primitives
+    belong to one event loop, so each loop gets its own.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(max_concurrent_requests)
+    return semaphore
+
+
+class _Call:
+    """
+    Records one LLM API request in the metrics and as a trace span: its latency, whether it
+    failed and, through `record`, the tokens it used and what they cost.
+    """
+
+    def __init__(self, model: str, call_site: str):
+        self.labels = {'model': model, 'call_site': call_site or 'unspecified'}
+        self.span = span(f'llm {self.labels["call_site"]}', 'llm', **self.labels)
+
+    def __enter__(self):
+        metrics.llm_requests.inc(**self.labels)
+        self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        metrics.llm_latency.observe(time.perf_counter() - self.started, **self.labels)
+        if exc_type is not None:
+            metrics.llm_errors.inc(**self.labels)
+        self.span.__exit__(exc_type, exc, traceback)
+
+    def record(self, response) -> None:
+        usage = response.get('usage') or {}
+        self.record_tokens(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+
+    def record_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        _record_tokens(self.labels['model'], self.labels['call_site'], prompt_tokens, completion_tokens)
+
+
+def _record_tokens(model: str, call_site: str, prompt_tokens: int, completion_tokens: int) -> None:
+    labels = {'model': model, 'call_site': call_site or 'unspecified'}
+    metrics.llm_prompt_tokens.inc(prompt_tokens, **labels)
+    metrics.llm_completion_tokens.inc(completion_tokens, **labels)
+    price = prices.get(model)
+    if price:
+        metrics.llm_cost.inc((prompt_tokens * price['prompt'] + completion_tokens * price.get('completion', 0))
+                             / 1000, **labels)
+
+
+def _cache_hit(model: str, call_site: str, count: int = 1) -> None:
+    metrics.llm_cache_hits.inc(count, model=model, call_site=call_site or 'unspecified')
+
+
+def _completion_request(prompt, max_tokens, temperature) -> dict:
+    return dict(model="text-davinci-003", prompt=prompt, max_tokens=max_tokens, temperature=temperature)
+
+
+def _completion_texts(response) -> List[str]:
+    return [choice.text.strip() for choice in response.choices]
+
+
+def generate_completion(prompt, max_tokens=50, temperature=0.8, cache_policy=CACHE_NEVER, call_site=None):
     """
     Generates completion(s) for a given prompt using GPT-3.
 
     :param prompt: The prompt to generate completion(s) for.
     :param max_tokens: The maximum number of tokens in the generated output.
     :param temperature: The creativity parameter (higher values result in more creative outputs).
+    :param cache_policy: When to reuse a cached response for the same request: CACHE_NEVER,
+        CACHE_ALWAYS or CACHE_DETERMINISTIC (only when temperature is 0).
+    :param call_site: Labels the call in the metrics.
     :return: A list of generated completions.
     """
-    response = openai.Completion.create(
-        model="text-davinci-003",
-        prompt=prompt,
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
-    completions = [choice.text.strip() for choice in response.choices]
+    request = _completion_request(prompt, max_tokens, temperature)
+    key = _cache_key(cache_policy, request)
+    if key is not None:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            _cache_hit(request['model'], call_site)
+            return json.loads(cached)
+
+    with _Call(request['model'], call_site) as call:
+        response = openai.Completion.create(**request)
+        call.record(response)
+    completions = _completion_texts(response)
+
+    if key is not None:
+        completion_cache.set(key, json.dumps(completions).encode('utf-8'))
+    return completions
+
+
+async def agenerate_completion(prompt, max_tokens=50, temperature=0.8, cache_policy=CACHE_NEVER, call_site=None):
+    """
+    Async version of generate_completion, at most max_concurrent_requests run at once.
+    """
+    request = _completion_request(prompt, max_tokens, temperature)
+    key = _cache_key(cache_policy, request)
+    if key is not None:
+        cached = await asyncio.to_thread(completion_cache.get, key)
+        if cached is not None:
+            _cache_hit(request['model'], call_site)
+            return json.loads(cached)
+
+    async with _request_slot():
+        with _Call(request['model'], call_site) as call:
+            response = await openai.Completion.acreate(**request)
+            call.record(response)
+    completions = _completion_texts(response)
+
+    if key is not None:
+        await asyncio.to_thread(completion_cache.set, key, json.dumps(completions).encode('utf-8'))
     return completions
 
 
-def generate_chat_completion(messages, model="gpt-3.5-turbo", max_tokens=50, temperature=0.8):
+def _chat_request(messages, model, max_tokens, temperature) -> dict:
+    return dict(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)
+
+
+def _chat_reply(response) -> str:
+    return response['choices'][0]['message']['content']
+
+
+def generate_chat_completion(messages, model="gpt-3.5-turbo", max_tokens=50, temperature=0.8,
+                             cache_policy=CACHE_NEVER, call_site=None):
     """
     Generates completion(s) for a given chat conversation using GPT-3 or GPT-4.
 
@@ -33,49 +219,286 @@ def generate_chat_completion(messages, model="gpt-3.5-turbo", max_tokens=50, tem
     :param model: The model to use for the chat conversation.
     :param max_tokens: The maximum number of tokens in the generated output.
     :param temperature: The creativity parameter (higher values result in more creative outputs).
+    :param cache_policy: When to reuse a cached response for the same request: CACHE_NEVER,
+        CACHE_ALWAYS or CACHE_DETERMINISTIC (only when temperature is 0).
+    :param call_site: Labels the call in the metrics.
     :return: The assistant's reply as a string.
     """
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
+    request = _chat_request(messages, model, max_tokens, temperature)
+    key = _cache_key(cache_policy, request)
+    if key is not None:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            _cache_hit(model, call_site)
+            return cached.decode('utf-8')
+
+    with _Call(model, call_site) as call:
+        response = openai.ChatCompletion.create(**request)
+        call.record(response)
+    reply = _chat_reply(response)
+
+    if key is not None:
+        completion_cache.set(key, reply.encode('utf-8'))
     # Return the reply
-    return response['choices'][0]['message']['content']
+    return reply
+
+
+class _LineSplitter:
+    """Passes the complete lines of text arriving in pieces to a callback."""
+
+    def __init__(self, on_line: Callable[[str], None]):
+        self.on_line = on_line
+        self.pending = ''
 
+    def feed(self, text: str) -> None:
+        *lines, self.pending = (self.pending + text).split('\n')
+        for line in lines:
+            self.on_line(line)
 
-def generate_embedding(text):
-    model_name = "text-embedding-ada-002"
+    def close(self) -> None:
+        if self.pending:
+            self.on_line(self.pending)
+            self.pending = ''
 
-    response = openai.Embedding.create(
-        model=model_name,
-        input=text
-    )["data"][0]["embedding"]
 
-    return response
+async def _astream_chat_reply(request: dict, on_line: Callable[[str], None], call: _Call) -> str:
+    splitter = _LineSplitter(on_line)
+    pieces = []
+    usage = None
+    # The usage comes in a last chunk without choices
+    chunks = await openai.ChatCompletion.acreate(stream=True, stream_options={'include_usage': True}, **request)
+    async for chunk in chunks:
+        if chunk.get('usage'):
+            usage = chunk['usage']
+        if not chunk.get('choices'):
+            continue
+        piece = chunk['choices'][0]['delta'].get('content')
+        if piece:
+            pieces.append(piece)
+            splitter.feed(piece)
+    splitter.close()
+    reply = ''.join(pieces)
+    if usage is None:
+        # Not every deployment reports the usage of a stream, estimate it instead
+        usage = {'prompt_tokens': sum(estimate_tokens(message['content']) for message in request['messages']),
+                 'completion_tokens': estimate_tokens(reply)}
+    call.record({'usage': usage})
+    return reply
+
+
+async def agenerate_chat_completion(messages, model="gpt-3.5-turbo", max_tokens=50, temperature=0.8,
+                                    cache_policy=CACHE_NEVER, call_site=None,
+                                    on_line: Callable[[str], None] = None):
+    """
+    Async version of generate_chat_completion, at most max_concurrent_requests run at once.
+    With `on_line` the reply is streamed and each of its lines is passed to on_line as soon
+    as it is complete, before the whole reply is returned.
+    """
+    request = _chat_request(messages, model, max_tokens, temperature)
+    key = _cache_key(cache_policy, request)
+    if key is not None:
+        cached = await asyncio.to_thread(completion_cache.get, key)
+        if cached is not None:
+            _cache_hit(model, call_site)
+            reply = cached.decode('utf-8')
+            if on_line is not None:
+                for line in reply.split('\n'):
+                    on_line(line)
+            return reply
+
+    async with _request_slot():
+        with _Call(model, call_site) as call:
+            if on_line is not None:
+                reply = await _astream_chat_reply(request, on_line, call)
+            else:
+                response = await openai.ChatCompletion.acreate(**request)
+                call.record(response)
+                reply = _chat_reply(response)
+
+    if key is not None:
+        await asyncio.to_thread(completion_cache.set, key, reply.encode('utf-8'))
+    return reply
+
+
+def _response_embeddings(response) -> List[List[float]]:
+    data = sorted(response["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in data]
+
+
+def _request_embeddings(texts: List[str], model_name=EMBEDDING_MODEL, call_site=None) -> List[List[float]]:
+    embeddings = []
+    for i in range(0, len(texts), embedding_batch_size):
+        with _Call(model_name, call_site) as call:
+            response = openai.Embedding.create(
+                model=model_name,
+                input=texts[i:i + embedding_batch_size]
+            )
+            call.record(response)
+        embeddings.extend(_response_embeddings(response))
+
+    return embeddings
+
+
+async def _arequest_embeddings(texts: List[str], model_name=EMBEDDING_MODEL, call_site=None) -> List[List[float]]:
+    async def request(batch):
+        async with _request_slot():
+            with _Call(model_name, call_site) as call:
+                response = await openai.Embedding.acreate(model=model_name, input=batch)
+                call.record(response)
+        return _response_embeddings(response)
+
+    # The batches are sent concurrently
+    responses = await asyncio.gather(*(request(texts[i:i + embedding_batch_size])
+                                       for i in range(0, len(texts), embedding_batch_size)))
+    return [embedding for embeddings in responses for embedding in embeddings]
+
+
+def _embedding_key(text: str, model_name: str) -> str:
+    return model_name + ':' + hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _pack_embedding(embedding: List[float]) -> bytes:
+    return array('f', embedding).tobytes()
+
+
+def _unpack_embedding(value: bytes) -> List[float]:
+    embedding = array('f')
+    embedding.frombytes(value)
+    return embedding.tolist()
+
+
+def _cached_embeddings(texts: List[str], model_name: str, call_site: str):
+    """Returns the cache keys of the texts, the embeddings found and the {key: text} still missing."""
+    keys = [_embedding_key(text, model_name) for text in texts]
+    found = {key: _unpack_embedding(value) for key, value in embedding_cache.get_many(keys).items()}
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+    if found:
+        _cache_hit(model_name, call_site, len(found))
+    return keys, found, missing
+
+
+def _store_embeddings(found: dict, missing: dict, new_embeddings: List[List[float]]) -> None:
+    found.update(zip(missing, new_embeddings))
+    embedding_cache.set_many({key: _pack_embedding(embedding)
+                              for key, embedding in zip(missing, new_embeddings)})
+
+
+def generate_embeddings(texts: List[str], model_name=EMBEDDING_MODEL, call_site=None) -> List[List[float]]:
+    """
+    Generates embeddings for many texts, one API call per embedding_batch_size texts.
+    Texts already in the embedding cache are not sent.
+
+    :param texts: The texts to embed.
+    :param model_name: The embedding model to use.
+    :param call_site: Labels the calls in the metrics.
+    :return: The embeddings in the same order as the texts.
+    """
+    if embedding_cache is None:
+        return _request_embeddings(texts, model_name, call_site)
+
+    keys, found, missing = _cached_embeddings(texts, model_name, call_site)
+    if missing:
+        _store_embeddings(found, missing, _request_embeddings(list(missing.values()), model_name, call_site))
+
+    return [found[key] for key in keys]
+
+
+async def agenerate_embeddings(texts: List[str], model_name=EMBEDDING_MODEL, call_site=None) -> List[List[float]]:
+    """
+    Async version of generate_embeddings, the API calls for the batches are made concurrently.
+    """
+    if embedding_cache is None:
+        return await _arequest_embeddings(texts, model_name, call_site)
+
+    keys, found, missing = await asyncio.to_thread(_cached_embeddings, texts, model_name, call_site)
+    if missing:
+        new_embeddings = await _arequest_embeddings(list(missing.values()), model_name, call_site)
+        await asyncio.to_thread(_store_embeddings, found, missing, new_embeddings)
+
+    return [found[key] for key in keys]
+
+
+def _request_batched_embeddings(requests: List[tuple]) -> List[List[float]]:
+    """
+    Embeds (text, call_site) pairs of different callers in one API call.  The request is
+    labelled embedding_batch, its tokens are split between the call sites by text length.
+    """
+    with _Call(EMBEDDING_MODEL, 'embedding_batch') as call:
+        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=[text for text, _ in requests])
+        prompt_tokens = (response.get('usage') or {}).get('prompt_tokens', 0)
+        call.span.set(prompt_tokens=prompt_tokens, completion_tokens=0)
+
+    lengths = {}
+    for text, call_site in requests:
+        lengths[call_site] = lengths.get(call_site, 0) + len(text)
+    total_length = sum(lengths.values()) or 1
+    remaining = prompt_tokens
+    for i, (call_site, length) in enumerate(lengths.items()):
+        share = remaining if i == len(lengths) - 1 else round(prompt_tokens * length / total_length)
+        remaining -= share
+        _record_tokens(EMBEDDING_MODEL, call_site, share, 0)
+    return _response_embeddings(response)
+
+
+# Single text calls made around the same time from different requests are sent as one batch
+_embedding_batcher = MicroBatcher(_request_batched_embeddings,
+                                  max_batch_size=embedding_batch_size,
+                                  max_wait_ms=embedding_batch_wait_ms)
+
+
+def generate_embedding(text, model_name=EMBEDDING_MODEL, call_site=None):
+    """
+    Embeds one text.  Unlike agenerate_embedding it is not micro-batched, waiting for a
+    batch would block the caller, and the event loop when called from a request handler.
+    """
+    if embedding_cache is not None:
+        key = _embedding_key(text, model_name)
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            _cache_hit(model_name, call_site)
+            return _unpack_embedding(cached)
+
+    embedding = _request_embeddings([text], model_name, call_site)[0]
+
+    if embedding_cache is not None:
+        embedding_cache.set(key, _pack_embedding(embedding))
+    return embedding
+
+
+async def agenerate_embedding(text, model_name=EMBEDDING_MODEL, call_site=None):
+    """
+    Async version of generate_embedding.  Single texts are still micro-batched, the caller
+    awaits the batch without holding up the event loop.
+    """
+    if embedding_cache is not None:
+        key = _embedding_key(text, model_name)
+        cached = await asyncio.to_thread(embedding_cache.get, key)
+        if cached is not None:
+            _cache_hit(model_name, call_site)
+            return _unpack_embedding(cached)
+
+    if embedding_batch_wait_ms <= 0 or model_name != EMBEDDING_MODEL:
+        embedding = (await _arequest_embeddings([text], model_name, call_site))[0]
+    else:
+        embedding = await asyncio.wrap_future(_embedding_batcher.submit((text, call_site)))
+
+    if embedding_cache is not None:
+        await asyncio.to_thread(embedding_cache.set, key, _pack_embedding(embedding))
+    return embedding
 
 
 def sanitize_ai_response(response_text):
-    valid_structure = False
-    while not valid_structure:
-        if len(response_text) == 0:
-            # TODO raise an appropriate exception
-            break
-        try:
-            parsed_response = ast.literal_eval(response_text)
-            valid_structure = True
-        except (SyntaxError, ValueError):
-            response_text = response_text[:-1]
+    """
+    The first Python list or JSON object in a model reply, repaired if the reply was cut off.
 
-    return parsed_response
+    :param response_text: The model's reply.
+    :return: The parsed list or object.
+    """
+    return extract_structure(response_text)
 
 
 def extract_json_string(text: str) -> str:
-    json_pattern = r'{.*}'
-    json_string = re.search(json_pattern, text, re.DOTALL)
-    if json_string:
-        return json_string.group()
-    else:
+    objects = parse_structures(text, openers='{')
+    if not objects:
         raise ValueError("No JSON string found in the input text")
-
+    return json.dumps(objects[0])
@@ -0,0 +1,141 @@
+import ast
+import json
+from typing import Any, List
+
+_CLOSING = {'[': ']', '{': '}'}
+_QUOTES = '"\''
+
+# Returned by _parse for text that is neither JSON nor a Python literal
+_INVALID = object()
+
+
+def _parse(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (SyntaxError, ValueError, TypeError, MemoryError, RecursionError):
+        return _INVALID
+
+
+class StructuredOutputParser:
+    """
+    Finds the Python lists and JSON objects in free-form model output, e.g. the list in
+    "Here is the backlog: ['item 1', 'item 2']".
+
+    The text is scanned once, keeping track of the open brackets and string literals, so it
+    can be fed in pieces as a reply streams in.  Each structure is parsed once, when its
+    last bracket arrives, structures that do not parse (e.g. "[see below]") are skipped.
+    `close` repairs a structure the reply left unfinished, e.g. when it ran into max_tokens.
+    """
+
+    def __init__(self, openers: str = '[{'):
+        """
+        :param openers: The brackets a structure may start with, '[' for lists only.
+        """
+        self.openers = openers
+        self.values: List[Any] = []
+        self._discard()
+
+    def _discard(self) -> None:
+        # Closing brackets of the open structure, innermost last
+        self._stack = []
+        self._quote = None
+        self._escaped = False
+        # Text of the open structure from earlier feeds and its length
+        self._pending = []
+        self._length = 0
+        # (length, closing brackets) after the last complete element and before the last comma
+        self._last_element = None
+        self._last_comma = None
+
+    def _closers(self) -> str:
+        return ''.join(reversed(self._stack))
+
+    def feed(self, text: str) -> List[Any]:
+        """Scans the next piece of the output, returns the structures it completed."""
+        found = []
+        start = 0 if self._stack else None
+        for i, char in enumerate(text):
+            if not self._stack:
+                if char in self.openers:
+                    self._stack.append(_CLOSING[char])
+                    start = i
+                continue
+
+            if self._quote is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+                    self._last_element = (self._length + i + 1 - start, self._closers())
+            elif char in _QUOTES:
+                self._quote = char
+            elif char in _CLOSING:
+                self._stack.append(_CLOSING[char])
+            elif char in ']}':
+                if char != self._stack.pop():
+                    # Unbalanced brackets, this was not a structure
+                    self._discard()
+                elif self._stack:
+                    self._last_element = (self._length + i + 1 - start, self._closers())
+                else:
+                    value = _parse(''.join(self._pending) + text[start:i + 1])
+                    if value is not _INVALID:
+                        found.append(value)
+                    self._discard()
+            elif char == ',':
+                self._last_comma = (self._length + i - start, self._closers())
+
+        if self._stack:
+            self._pending.append(text[start:])
+            self._length += len(text) - start
+        self.values.extend(found)
+        return found
+
+    def close(self, repair: bool = True) -> List[Any]:
+        """
+        Ends the output.  With `repair` an unfinished structure is completed, preferably by
+        dropping its unfinished last element, and returned if that makes it parse.
+        """
+        if not self._stack or not repair:
+            self._discard()
+            return []
+
+        text = ''.join(self._pending)
+        candidates = []
+        # Cut back to the last complete element, or to the last comma
+        for mark in (self._last_element, self._last_comma):
+            if mark is not None:
+                candidates.append(text[:mark[0]] + mark[1])
+        # Keep the unfinished last element, closing its string
+        tail = text[:-1] if self._escaped else text
+        candidates.append(tail + (self._quote or '') + self._closers())
+
+        self._discard()
+        for candidate in candidates:
+            value = _parse(candidate)
+            if value is not _INVALID:
+                self.values.append(value)
+                return [value]
+        return []
+
+
+def parse_structures(text: str, openers: str = '[{', repair: bool = True) -> List[Any]:
+    """All lists and objects in the text, in order, see StructuredOutputParser."""
+    parser = StructuredOutputParser(openers)
+    parser.feed(text)
+    parser.close(repair)
+    return parser.values
+
+
+def extract_structure(text: str, openers: str = '[{', repair: bool = True) -> Any:
+    """The first list or object in the text, raises ValueError when there is none."""
+    values = parse_structures(text, openers, repair)
+    if not values:
+        raise ValueError('No list or object found in the model output')
+    return values[0]
@@ -0,0 +1,88 @@
+from typing import Callable, List
+import numpy as np
+import logging
+from shared_utils.logging_config import setup_logging
+from shared_utils.configurations import configurations
+from shared_utils.nlp import agenerate_embedding, agenerate_embeddings, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens a prompt may use, the project's file list gets whatever the rest of the prompt leaves
+prompt_token_budget = configurations.get('prompts', 'token_budget', default=2000)
+
+FILES_HEADER = 'id,file path,file name,purpose\n'
+
+
+class FileCatalog:
+    """
+    The rows of a project structure's file list, rendered once, with their token counts.
+    The embeddings of the rows are made the first time the list has to be cut down.
+    """
+
+    def __init__(self, structure: dict):
+        self.structure = structure
+        self.rows = ['{},{},{},{}\n'.format(i, file_data['path'], file_data['name'], file_data['purpose'])
+                     for i, file_data in enumerate(structure['files'])]
+        self.row_tokens = [estimate_tokens(row) for row in self.rows]
+        self.total_tokens = estimate_tokens(FILES_HEADER) + sum(self.row_tokens)
+        self._embeddings = None
+
+    async def embeddings(self) -> np.ndarray:
+        if self._embeddings is None:
+            embeddings = np.asarray(await agenerate_embeddings(self.rows, call_site='prompt_file_selection'),
+                                    dtype=np.float32)
+            self._embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return self._embeddings
+
+    async def render(self, query: str, token_budget: int) -> str:
+        """
+        The file list in at most `token_budget` tokens.  When the whole list does not fit, the
+        rows most similar to the query are kept, at least one, in their original order.
+        """
+        if self.total_tokens <= token_budget or not self.rows:
+            return FILES_HEADER + ''.join(self.rows)
+
+        query_embedding = np.asarray(await agenerate_embedding(query, call_site='prompt_file_selection'),
+                                     dtype=np.float32)
+        scores = (await self.embeddings()) @ query_embedding
+        selected = []
+        used = estimate_tokens(FILES_HEADER)
+        for i in np.argsort(-scores):
+            if selected and used + self.row_tokens[i] > token_budget:
+                break
+            selected.append(i)
+            used += self.row_tokens[i]
+        logger.debug(f'Prompt file list cut to {len(selected)} of {len(self.rows)} files')
+        return FILES_HEADER + ''.join(self.rows[i] for i in sorted(selected))
+
+
+# Catalogs of the structures seen last.  Context returns the same structure object until the
+# project changes, so a catalog is looked up by identity.
+_catalogs: List[FileCatalog] = []
+_max_catalogs = 4
+
+
+def file_catalog(structure: dict) -> FileCatalog:
+    for catalog in _catalogs:
+        if catalog.structure is structure:
+            return catalog
+    catalog = FileCatalog(structure)
+    _catalogs.insert(0, catalog)
+    del _catalogs[_max_catalogs:]
+    return catalog
+
+
+async def assemble_prompt(build: Callable[[str], str], structure: dict, query: str,
+                          token_budget: int = None) -> str:
+    """
+    Builds a prompt that lists the project's files within the token budget.
+
+    :param build: Returns the prompt for a given file list.
+    :param structure: The project structure, as returned by Context.
+    :param query: What the prompt is about, used to pick the relevant files when not all fit.
+    :param token_budget: Tokens for the whole prompt, prompts.token_budget by default.
+    :return: The prompt.
+    """
+    token_budget = prompt_token_budget if token_budget is None else token_budget
+    files_budget = token_budget - estimate_tokens(build(''))
+    return build(await file_catalog(structure).render(query, files_budget))
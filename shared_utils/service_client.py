@@ -0,0 +1,121 @@
+import asyncio
+import json
+from typing import Callable
+import httpx
+from shared_utils.configurations import configurations
+from shared_utils.tracing import span, inject_headers
+import logging
+from shared_utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+default_timeout = configurations.get('http', 'timeout', default=30)
+endpoint_timeouts = configurations.get('http', 'timeouts', default={})
+max_retries = configurations.get('http', 'retries', default=3)
+backoff_seconds = configurations.get('http', 'backoff_seconds', default=0.5)
+
+# Failures where the request never reached the service, safe to retry for any method
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Responses retried for idempotent methods only, a proxy may answer 502 after the service ran the request
+RETRY_STATUS_CODES = (502, 503)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_client = None
+_client_loop = None
+
+
+def service_address(service: str) -> str:
+    host = configurations.get('microservices', service, 'hostname')
+    port = configurations.get('microservices', service, 'port')
+    return f"http://{host}:{port}"
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the process wide keep-alive client.  A new one is made if the event loop changed,
+    connections cannot be shared between loops.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        limits = httpx.Limits(max_connections=configurations.get('http', 'max_connections', default=100),
+                              max_keepalive_connections=configurations.get('http', 'max_keepalive_connections',
+                                                                           default=20))
+        _client = httpx.AsyncClient(limits=limits, timeout=default_timeout)
+        _client_loop = loop
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def service_request(method: str, service: str, endpoint: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request to another SprintSwarm service with the endpoint's configured timeout.
+    Connection failures are retried with exponential backoff, 502/503 responses only for GET.
+    The request joins the current trace.
+    """
+    url = service_address(service) + endpoint
+    kwargs.setdefault('timeout', endpoint_timeouts.get(endpoint, default_timeout))
+    with span(f'{method} {service}{endpoint}', 'client', service=service) as client_span:
+        kwargs['headers'] = inject_headers(kwargs.get('headers'))
+        for attempt in range(max_retries + 1):
+            try:
+                response = await get_client().request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or method.upper() not in IDEMPOTENT_METHODS \
+                        or attempt == max_retries:
+                    client_span.set(status_code=response.status_code, attempts=attempt + 1)
+                    return response
+                logger.warning(f'{method} {url} returned {response.status_code}, retrying')
+            except RETRY_EXCEPTIONS as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning(f'{method} {url} failed ({e!r}), retrying')
+            await asyncio.sleep(backoff_seconds * 2 ** attempt)
+
+
+async def service_get(service: str, endpoint: str, **kwargs) -> httpx.Response:
+    return await service_request('GET', service, endpoint, **kwargs)
+
+
+async def service_post(service: str, endpoint: str, **kwargs) -> httpx.Response:
+    return await service_request('POST', service, endpoint, **kwargs)
+
+
+async def service_stream(method: str, service: str, endpoint: str, on_event: Callable[[dict], None],
+                         **kwargs) -> dict:
+    """
+    Calls an endpoint of another service in streaming mode and passes each NDJSON event to
+    `on_event` as it arrives.  Returns the last event, 'done' with the endpoint's result or
+    'error'.  Only connection failures are retried, a stream cannot be replayed once started.
+    """
+    url = service_address(service) + endpoint
+    kwargs.setdefault('timeout', endpoint_timeouts.get(endpoint, default_timeout))
+    kwargs['params'] = {**kwargs.get('params', {}), 'stream': 'true'}
+    with span(f'{method} {service}{endpoint}', 'client', service=service, stream=True) as client_span:
+        kwargs['headers'] = inject_headers(kwargs.get('headers'))
+        for attempt in range(max_retries + 1):
+            try:
+                async with get_client().stream(method, url, **kwargs) as response:
+                    client_span.set(status_code=response.status_code, attempts=attempt + 1)
+                    if response.status_code != 200:
+                        await response.aread()
+                        return {'event': 'error', 'status_code': response.status_code, 'message': response.text}
+                    last = {'event': 'error', 'message': 'Stream ended without a result'}
+                    async for line in response.aiter_lines():
+                        if line.strip():
+                            event = json.loads(line)
+                            if event.get('event') in ('done', 'error'):
+                                last = event
+                            else:
+                                on_event(event)
+                    return last
+            except RETRY_EXCEPTIONS as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning(f'{method} {url} failed ({e!r}), retrying')
+            await asyncio.sleep(backoff_seconds * 2 ** attempt)
@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+# Stay well below SQLite's bound parameter limit
+MAX_PARAMETERS = 500
+
+
+class ThreadConnections:
+    """
+    Connections to one SQLite file, one per thread as sqlite3 connections cannot be shared
+    between threads.  The database runs in WAL mode so readers never block on a writer.
+    """
+
+    def __init__(self, path: str, isolation_level: Optional[str] = ''):
+        self.path = path
+        self.isolation_level = isolation_level
+        self._local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=self.isolation_level)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+
+def chunks(values: Sequence, size: int = MAX_PARAMETERS) -> Iterator[Tuple[List, str]]:
+    """Splits the values of an `IN (...)` query, yields each chunk with its placeholders."""
+    for i in range(0, len(values), size):
+        chunk = list(values[i:i + size])
+        yield chunk, ','.join('?' * len(chunk))
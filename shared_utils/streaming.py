@@ -0,0 +1,63 @@
+import asyncio
+import json
+from typing import AsyncIterator, Awaitable, Callable
+from fastapi.responses import StreamingResponse
+import logging
+from shared_utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+NDJSON = 'application/x-ndjson'
+
+# Receives the progress events of a long running endpoint, e.g. {'event': 'task_completed', ...}
+Emit = Callable[[dict], None]
+# The work of an endpoint, reports its progress through emit and returns the endpoint's result
+Work = Callable[[Emit], Awaitable[dict]]
+
+_END = object()
+
+
+def no_emit(event: dict) -> None:
+    pass
+
+
+def encode_event(event: dict) -> bytes:
+    return (json.dumps(event, default=str) + '\n').encode('utf-8')
+
+
+async def _events(work: Work) -> AsyncIterator[bytes]:
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            result = await work(queue.put_nowait)
+            queue.put_nowait({'event': 'done', **result})
+        except Exception as e:
+            logger.exception('Streamed request failed')
+            queue.put_nowait({'event': 'error', 'message': repr(e)})
+        finally:
+            queue.put_nowait(_END)
+
+    # The work runs in its own task so events are sent while it is still going
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            event = await queue.get()
+            if event is _END:
+                break
+            yield encode_event(event)
+    finally:
+        # The client went away before the work finished
+        if not task.done():
+            task.cancel()
+
+
+async def respond(work: Work, stream: bool = False):
+    """
+    Runs the work of an endpoint.  Without `stream` the work's result is returned once it is
+    done.  With `stream` the response is NDJSON: every event the work emits, as it happens,
+    then a 'done' event carrying the result, or an 'error' event if the work failed.
+    """
+    if not stream:
+        return await work(no_emit)
+    return StreamingResponse(_events(work), media_type=NDJSON)
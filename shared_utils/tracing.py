@@ -0,0 +1,244 @@
+import asyncio
+import contextvars
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from typing import Dict, Optional
+from fastapi import FastAPI, Request
+import logging
+from shared_utils.logging_config import setup_logging
+from shared_utils.configurations import configurations
+
+logger = logging.getLogger(__name__)
+
+# Finished spans are appended to this file, one JSON object per line, by every service on the host
+tracing_enabled = configurations.get('tracing', 'enabled', default=False)
+tracing_path = configurations.get('tracing', 'path', default='./sprintswarm/traces/spans.jsonl')
+# Once the file reaches this size it is moved to <path>.1, replacing the previous one, 0 never rotates
+tracing_max_bytes = configurations.get('tracing', 'max_bytes', default=10 * 1024 * 1024)
+
+# W3C trace context header, carries the trace id and the calling span's id between services
+TRACEPARENT = 'traceparent'
+
+# Name of the service this process runs, recorded on every span
+service_name = 'unknown'
+
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+_export_lock = threading.Lock()
+
+
+def _lane() -> int:
+    """Identifies the asyncio task or thread a span runs on, spans on one lane nest properly."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+class Span:
+    """
+    A timed operation of a trace.  Used as a context manager it becomes the parent of the
+    spans started inside it, in this task or thread and in the services it calls.
+    """
+
+    def __init__(self, name: str, kind: str = 'internal', trace_id: str = None, parent_id: str = None,
+                 **attributes):
+        parent = _current_span.get()
+        if trace_id is None and parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.status = 'ok'
+        self._token = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def begin(self) -> 'Span':
+        """Starts timing the span without making it the current span."""
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._lane = _lane()
+        return self
+
+    def end(self, error: BaseException = None) -> None:
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.status = 'error'
+            self.attributes['error'] = repr(error)
+        _export(self)
+
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def __enter__(self):
+        self.begin()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self._token)
+        self.end(exc)
+
+    def to_dict(self) -> dict:
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'name': self.name, 'kind': self.kind, 'service': service_name, 'pid': os.getpid(),
+                'lane': self._lane, 'start': self.start, 'duration': self.duration, 'status': self.status,
+                'attributes': self.attributes}
+
+
+def span(name: str, kind: str = 'internal', **attributes) -> Span:
+    """Starts a child of the current span, or a new trace when there is none."""
+    return Span(name, kind, **attributes)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def inject_headers(headers: Dict[str, str] = None) -> Dict[str, str]:
+    """Adds the current span's trace context to the headers of an outgoing request."""
+    headers = dict(headers or {})
+    current = _current_span.get()
+    if current is not None:
+        headers[TRACEPARENT] = current.traceparent()
+    return headers
+
+
+def _parse_traceparent(value: Optional[str]):
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+def _open_span_log() -> int:
+    # O_APPEND keeps whole lines from the processes sharing the file
+    return os.open(tracing_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def _rotate(fd: int) -> int:
+    """Moves the full span log aside and opens a new one, unless another process already did."""
+    try:
+        if os.path.samestat(os.fstat(fd), os.stat(tracing_path)):
+            os.replace(tracing_path, tracing_path + '.1')
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+    return _open_span_log()
+
+
+def _export(finished: Span) -> None:
+    if not tracing_enabled:
+        return
+    line = (json.dumps(finished.to_dict(), default=str) + '\n').encode('utf-8')
+    try:
+        with _export_lock:
+            directory = os.path.dirname(tracing_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = _open_span_log()
+            try:
+                if tracing_max_bytes and os.fstat(fd).st_size >= tracing_max_bytes:
+                    fd = _rotate(fd)
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    except OSError as e:
+        logger.warning(f'Could not export span {finished.name}: {e}')
+
+
+def install_tracing(app: FastAPI, service: str) -> None:
+    """
+    Records a server span for every request the app handles.  Requests that carry a
+    traceparent header join the caller's trace, the others start a new one.
+    """
+    global service_name
+    service_name = service
+
+    @app.middleware('http')
+    async def trace_request(request: Request, call_next):
+        trace_id, parent_id = _parse_traceparent(request.headers.get(TRACEPARENT))
+        server_span = Span(f'{request.method} {request.url.path}', 'server', trace_id=trace_id,
+                           parent_id=parent_id, service=service).begin()
+        token = _current_span.set(server_span)
+        try:
+            response = await call_next(request)
+        except BaseException as e:
+            server_span.end(e)
+            raise
+        finally:
+            _current_span.reset(token)
+        server_span.set(status_code=response.status_code)
+        response.headers['x-trace-id'] = server_span.trace_id
+        # A streamed response is still working after its headers are sent
+        response.body_iterator = _end_with_body(response.body_iterator, server_span)
+        return response
+
+
+async def _end_with_body(body, server_span: Span):
+    """Passes the response body on and ends the server span once it is sent, or the client went away."""
+    error = None
+    try:
+        async for chunk in body:
+            yield chunk
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        server_span.end(error)
+
+
+def to_chrome_trace(spans: list) -> dict:
+    """
+    Converts exported spans to the Chrome trace event format, viewable as a flame chart in
+    chrome://tracing or Perfetto.  Each service is shown as a process, each task or thread as
+    a row within it.
+    """
+    events = []
+    processes = {}
+    for record in sorted(spans, key=lambda record: record['start']):
+        process = (record['service'], record['pid'])
+        if process not in processes:
+            processes[process] = len(processes) + 1
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': processes[process],
+                           'args': {'name': f'{record["service"]} ({record["pid"]})'}})
+        events.append({'name': record['name'], 'cat': record['kind'], 'ph': 'X',
+                       'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6,
+                       'pid': processes[process], 'tid': record['lane'],
+                       'args': {'trace_id': record['trace_id'], 'span_id': record['span_id'],
+                                'parent_id': record['parent_id'], 'status': record['status'],
+                                **record['attributes']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def load_spans(path: str, trace_id: str = None) -> list:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if trace_id is None or record['trace_id'] == trace_id:
+                    spans.append(record)
+    return spans
+
+
+if __name__ == '__main__':
+    # python -m shared_utils.tracing spans.jsonl trace.json [trace_id]
+    if len(sys.argv) < 3:
+        print('usage: python -m shared_utils.tracing <spans.jsonl> <trace.json> [trace_id]')
+        sys.exit(1)
+    selected = load_spans(sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else None)
+    with open(sys.argv[2], 'w') as output:
+        json.dump(to_chrome_trace(selected), output)
+    print(f'Wrote {len(selected)} spans to {sys.argv[2]}')
@@ -0,0 +1,61 @@
+from shared_utils.configurations import configurations
+from shared_utils.vector_database_base import VectorDatabaseBase
+from shared_utils.tracing import span
+import functools
+import logging
+from shared_utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+_vector_db = None
+
+
+class TracedVectorDatabase:
+    """Wraps a vector database so each call of its public methods is recorded as a span."""
+
+    def __init__(self, vector_db: VectorDatabaseBase):
+        self._vector_db = vector_db
+
+    def __getattr__(self, name):
+        attribute = getattr(self._vector_db, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def traced(*args, **kwargs):
+            with span(f'vector_db.{name}', 'vector_db', backend=type(self._vector_db).__name__,
+                      namespace=kwargs.get('namespace')):
+                return attribute(*args, **kwargs)
+        return traced
+
+
+def get_vector_database() -> VectorDatabaseBase:
+    """
+    Returns the process wide vector database selected by `vector_database.backend` in the config.
+
+    'pinecone' (the default) uses the hosted index, 'numpy' keeps the vectors in process and
+    persists them under `vector_database.path`.  Namespaces listed in `vector_database.ann.namespaces`
+    get an approximate IVF index tuned by `vector_database.ann.params`.
+    """
+    global _vector_db
+    if _vector_db is None:
+        backend = configurations.get('vector_database', 'backend', default='pinecone')
+        if backend == 'numpy':
+            from shared_utils.NumpyDatabase import NumpyDatabase
+            _vector_db = NumpyDatabase(configurations.get('vector_database', 'path',
+                                                          default='./sprintswarm/vectors'),
+                                       ann_namespaces=configurations.get('vector_database', 'ann', 'namespaces',
+                                                                         default=[]),
+                                       ann_params=configurations.get('vector_database', 'ann', 'params',
+                                                                     default={}))
+        elif backend == 'pinecone':
+            from shared_utils.PineconeDatabase import PineconeDatabase
+            _vector_db = PineconeDatabase(configurations.get('pinecone', 'api_key'),
+                                          upsert_batch_size=configurations.get('pinecone', 'upsert_batch_size',
+                                                                               default=100),
+                                          max_workers=configurations.get('pinecone', 'max_workers', default=4))
+        else:
+            raise ValueError(f'Unknown vector database backend: {backend}')
+        _vector_db = TracedVectorDatabase(_vector_db)
+        logger.debug(f'Using {backend} vector database')
+    return _vector_db
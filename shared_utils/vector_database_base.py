@@ -1,11 +1,42 @@
 from abc import ABC, abstractmethod
-from typing import List
-from shared_utils.models import BacklogItem
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any
+from shared_utils.models import BacklogItem, CodeBaseFunction
+
+
+def backlog_item_vector(item: BacklogItem, vector: List[float]) -> dict:
+    """Builds the upsert record for a backlog item."""
+    return {'id': item.id, 'values': vector, 'metadata':
+            {'priority': str(item.priority),
+             'assignee': str(item.assignee),
+             'status': str(item.status)}}
+
+
+def code_vector(code_base_func: CodeBaseFunction) -> dict:
+    """Builds the upsert record for an indexed function."""
+    metadata = {
+        "id": code_base_func.id,
+        "function_name": code_base_func.function_name,
+        "file_path": code_base_func.file_path,
+        "code": code_base_func.code,
+        "description": code_base_func.description
+    }
+    # Location of the definition, when the extractor provided it
+    for key in ("kind", "start_line", "end_line"):
+        if getattr(code_base_func, key) is not None:
+            metadata[key] = getattr(code_base_func, key)
+    return {'id': code_base_func.id, 'values': code_base_func.embedding, 'metadata': metadata}
 
 
 class VectorDatabaseBase(ABC):
     _instance = None
 
+    # Size caps for one request of the bulk methods and how many requests run at once
+    upsert_batch_size = 100
+    fetch_batch_size = 1000
+    delete_batch_size = 1000
+    max_workers = 4
+
     def __call__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super().__new__(cls, *args, **kwargs)
@@ -19,7 +50,7 @@ class VectorDatabaseBase(ABC):
         pass
 
     @abstractmethod
-    def delete(self, vector_ids: List[str]) -> None:
+    def delete(self, vector_ids: List[str], namespace: str = None) -> None:
         pass
 
     @abstractmethod
@@ -27,3 +58,42 @@ class VectorDatabaseBase(ABC):
                num_relevant: int = 5,
                namespace: str = None):
         pass
+
+    def upsert_many(self, vectors: List[dict], namespace: str) -> None:
+        """
+        Upserts {'id', 'values', 'metadata'} records, split into chunks of upsert_batch_size
+        that are sent concurrently.
+        """
+        self._map_chunks(lambda chunk: self._upsert_chunk(chunk, namespace), vectors, self.upsert_batch_size)
+
+    def delete_many(self, vector_ids: List[str], namespace: str = None) -> None:
+        self._map_chunks(lambda chunk: self._delete_chunk(chunk, namespace), vector_ids, self.delete_batch_size)
+
+    def fetch_many(self, element_ids: List[Any], namespace: Any) -> dict:
+        """Fetches many ids, the result has the same {'vectors': {id: ...}} shape as fetch."""
+        vectors = {}
+        responses = self._map_chunks(lambda chunk: self._fetch_chunk(chunk, namespace),
+                                     element_ids, self.fetch_batch_size)
+        for response in responses:
+            vectors.update(response['vectors'])
+        return {'vectors': vectors, 'namespace': namespace}
+
+    @abstractmethod
+    def _upsert_chunk(self, vectors: List[dict], namespace: str) -> None:
+        pass
+
+    def _delete_chunk(self, vector_ids: List[str], namespace: str) -> None:
+        self.delete(vector_ids, namespace=namespace)
+
+    @abstractmethod
+    def _fetch_chunk(self, element_ids: List[Any], namespace: Any) -> dict:
+        pass
+
+    def _map_chunks(self, send, elements: list, chunk_size: int) -> list:
+        chunks = [elements[i:i + chunk_size] for i in range(0, len(elements), chunk_size)]
+        if len(chunks) <= 1:
+            return [send(chunk) for chunk in chunks]
+
+        if getattr(self, '_executor', None) is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self._executor.map(send, chunks))
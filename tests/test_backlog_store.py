@@ -0,0 +1,66 @@
+from shared_utils.backlog_store import BacklogStore
+from shared_utils.models import BacklogItem
+
+
+def make_item(description, priority=1):
+    return BacklogItem(priority=priority, item={'description': description})
+
+
+def open_stores(tmp_path, **kwargs):
+    path = str(tmp_path / 'backlog.sqlite')
+    return BacklogStore(path, 'product', **kwargs), BacklogStore(path, 'product', **kwargs)
+
+
+def test_load_and_changes(tmp_path):
+    first, second = open_stores(tmp_path)
+    a, b = make_item('a'), make_item('b', 2)
+    _, seq = first.write(0, [a, b])
+
+    items, second_seq = second.load()
+    assert sorted(item.item['description'] for item in items) == ['a', 'b']
+    assert second_seq == seq
+    assert second.changes(second_seq) == ({}, seq)
+
+    a.priority = 5
+    _, seq = first.write(seq, [a], deleted_ids=[b.id])
+    changes, new_seq = second.changes(second_seq)
+    assert new_seq == seq
+    assert changes[a.id].priority == 5 and changes[b.id] is None
+
+
+def test_write_returns_the_changes_it_had_not_seen(tmp_path):
+    first, second = open_stores(tmp_path)
+    _, first_seq = first.write(0, [make_item('a')])
+    _, second_seq = second.load()
+
+    _, first_seq = first.write(first_seq, [make_item('b')])
+    changes, second_seq = second.write(second_seq, [make_item('c')])
+    # Only the other process's write, not the one just made
+    assert [item.item['description'] for item in changes.values()] == ['b']
+    changes, first_seq = first.changes(first_seq)
+    assert [item.item['description'] for item in changes.values()] == ['c']
+    assert first_seq == second_seq
+
+
+def test_trimmed_log_asks_for_a_reload(tmp_path):
+    first, second = open_stores(tmp_path, max_changes=2)
+    _, seq = first.write(0, [make_item('a')])
+    _, since = second.load()
+    for description in 'bcd':
+        _, seq = first.write(seq, [make_item(description)])
+
+    # The changes after `since` have been trimmed from the log
+    assert second.changes(since) == (None, seq)
+    items, since = second.load()
+    assert len(items) == 4 and since == seq
+    _, seq = first.write(seq, [make_item('e')])
+    changes, _ = second.changes(since)
+    assert [item.item['description'] for item in changes.values()] == ['e']
+
+
+def test_backlogs_do_not_see_each_others_items(tmp_path):
+    path = str(tmp_path / 'backlog.sqlite')
+    product, sprint = BacklogStore(path, 'product'), BacklogStore(path, 'sprint')
+    _, seq = product.write(0, [make_item('a')])
+    assert sprint.load() == ([], seq)
+    assert sprint.changes(0) == ({}, seq)
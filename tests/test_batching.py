@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import pytest
+from shared_utils.batching import MicroBatcher
+
+
+def test_items_are_batched_in_order():
+    batches = []
+
+    def process(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(6)]
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4, 6, 8, 10]
+    assert [len(batch) for batch in batches] == [4, 2]
+
+
+def test_failed_and_short_batches_fail_their_futures():
+    batcher = MicroBatcher(lambda items: 1 / 0, max_wait_ms=1)
+    with pytest.raises(ZeroDivisionError):
+        batcher.submit('a').result(timeout=5)
+
+    batcher = MicroBatcher(lambda items: items[:1], max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(3)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+
+def test_cancelled_callers_do_not_stop_the_worker():
+    release = threading.Event()
+
+    def process(items):
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(process, max_wait_ms=1)
+
+    async def main():
+        # Cancelled while its batch is being processed
+        running = asyncio.ensure_future(asyncio.wrap_future(batcher.submit('running')))
+        await asyncio.sleep(0.05)
+        # Cancelled while still queued behind the running batch
+        queued = batcher.submit('queued')
+        running.cancel()
+        assert queued.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+        return await asyncio.wait_for(asyncio.wrap_future(batcher.submit('next')), 5)
+
+    assert asyncio.run(main()) == 'next'
+    assert batcher._worker.is_alive()
@@ -0,0 +1,62 @@
+import random
+from shared_utils.indexed_heap import IndexedHeap
+from shared_utils.models import BacklogItem
+
+
+def make_items(count, seed=0):
+    rng = random.Random(seed)
+    return [BacklogItem(priority=rng.randrange(count), item={'description': f'item {i}'}) for i in range(count)]
+
+
+def assert_heap(heap):
+    items = heap._heap
+    for position, item in enumerate(items):
+        assert heap._positions[item.id] == position
+        if position:
+            assert not item < items[(position - 1) // 2]
+    assert len(heap._positions) == len(items)
+
+
+def test_top_k_matches_sorted_order():
+    items = make_items(1000)
+    heap = IndexedHeap(items)
+    assert_heap(heap)
+    expected = sorted(item.priority for item in items)
+    assert [item.priority for item in heap.top_k(25)] == expected[:25]
+    assert len(heap.top_k(5000)) == 1000
+    # top_k leaves the heap as it was
+    assert len(heap) == 1000
+    assert_heap(heap)
+
+
+def test_remove_and_update_priority():
+    items = make_items(500, seed=1)
+    heap = IndexedHeap()
+    for item in items:
+        heap.push(item)
+
+    for item in items[::3]:
+        assert heap.remove(item.id) is item
+    assert heap.remove('missing') is None
+    assert_heap(heap)
+
+    for item in items[1::3]:
+        item.priority = -item.priority
+        heap.reorder(item.id)
+    assert_heap(heap)
+
+    remaining = [item for i, item in enumerate(items) if i % 3]
+    assert [heap.pop().priority for _ in range(len(heap))] == sorted(item.priority for item in remaining)
+
+
+def test_push_replaces_item_with_same_id():
+    heap = IndexedHeap(make_items(10))
+    replacement = BacklogItem(priority=-1, item={'description': 'item 3'})
+    heap.push(replacement)
+    assert len(heap) == 10
+    assert heap.get(replacement.id) is replacement
+    assert heap.peek() is replacement
+
+    heap.extend(make_items(100, seed=2))
+    assert len(heap) == 100
+    assert_heap(heap)
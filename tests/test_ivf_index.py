@@ -0,0 +1,79 @@
+import time
+import numpy as np
+from shared_utils.ivf_index import IVFIndex
+
+
+def make_dataset(count=20000, dimension=64, clusters=200, queries=100, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    vectors = centers[rng.integers(clusters, size=count)] + 1.0 * rng.normal(size=(count, dimension))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    query_vectors = vectors[rng.choice(count, queries, replace=False)] + 0.05 * rng.normal(size=(queries, dimension))
+    query_vectors = (query_vectors / np.linalg.norm(query_vectors, axis=1, keepdims=True)).astype(np.float32)
+    return [str(i) for i in range(count)], vectors, query_vectors
+
+
+def recall_at_k(index, ids, vectors, queries, k=10, nprobe=None):
+    """Average fraction of the exact top k neighbours returned by the index, and mean query time."""
+    hits = 0
+    elapsed = 0.0
+    for query in queries:
+        exact = np.argsort(-(vectors @ query))[:k]
+        start = time.perf_counter()
+        found, _ = index.search(query, k, nprobe=nprobe)
+        elapsed += time.perf_counter() - start
+        hits += len({ids[i] for i in exact} & set(found))
+    return hits / (k * len(queries)), elapsed / len(queries)
+
+
+def test_recall_against_exact_search():
+    ids, vectors, queries = make_dataset()
+    index = IVFIndex(nlist=64, nprobe=8)
+    index.add(ids, vectors)
+    assert index.trained
+
+    recall, _ = recall_at_k(index, ids, vectors, queries, nprobe=8)
+    assert recall >= 0.9
+    exhaustive_recall, _ = recall_at_k(index, ids, vectors, queries, nprobe=64)
+    assert exhaustive_recall == 1.0
+
+
+def test_incremental_insert_and_delete():
+    ids, vectors, queries = make_dataset(count=5000)
+    index = IVFIndex(nlist=16, nprobe=16)
+    index.add(ids[:4000], vectors[:4000])
+    index.add(ids[4000:], vectors[4000:])
+    index.remove(ids[:100])
+    assert len(index) == 4900
+
+    found, _ = index.search(vectors[0], 5)
+    assert '0' not in found
+    found, scores = index.search(vectors[4500], 1)
+    assert found == ['4500']
+    assert scores[0] > 0.99
+
+
+def test_save_and_load(tmp_path):
+    ids, vectors, queries = make_dataset(count=5000)
+    index = IVFIndex(nlist=16, nprobe=4)
+    index.add(ids, vectors)
+    index.save(str(tmp_path / 'ivf.npz'))
+
+    restored = IVFIndex(nlist=16, nprobe=4)
+    restored.load(str(tmp_path / 'ivf.npz'), ids, vectors)
+    for query in queries[:10]:
+        assert index.search(query, 10)[0] == restored.search(query, 10)[0]
+
+
+if __name__ == '__main__':
+    # Recall / latency trade-off table for tuning nprobe
+    ids, vectors, queries = make_dataset()
+    index = IVFIndex(nlist=64)
+    index.add(ids, vectors)
+    start = time.perf_counter()
+    for query in queries:
+        np.argpartition(-(vectors @ query), 10)[:10]
+    print(f'exact     latency={(time.perf_counter() - start) / len(queries) * 1e6:.0f}us')
+    for nprobe in [1, 2, 4, 8, 16, 32, 64]:
+        recall, latency = recall_at_k(index, ids, vectors, queries, nprobe=nprobe)
+        print(f'nprobe={nprobe:<3} recall@10={recall:.3f} latency={latency * 1e6:.0f}us')
@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+import numpy as np
+from shared_utils.NumpyDatabase import NumpyDatabase, _Namespace
+
+
+def make_vectors(count, dimension=8, start=0, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{'id': str(i), 'values': rng.normal(size=dimension).tolist(), 'metadata': {'n': i}}
+            for i in range(start, start + count)]
+
+
+def ids_of(db, namespace='ns'):
+    return sorted(db.fetch_many([str(i) for i in range(1000)], namespace)['vectors'])
+
+
+def test_writes_persist_across_instances(tmp_path):
+    db = NumpyDatabase(str(tmp_path))
+    vectors = make_vectors(20)
+    db.upsert_many(vectors, 'ns')
+    db.delete_many(['3', '4'], 'ns')
+    db.upsert_many([{**vectors[5], 'metadata': {'n': 'updated'}}], 'ns')
+
+    reopened = NumpyDatabase(str(tmp_path))
+    assert ids_of(reopened) == sorted(str(i) for i in range(20) if i not in (3, 4))
+    assert reopened.fetch('5', 'ns')['vectors']['5']['metadata'] == {'n': 'updated'}
+    match = reopened.search(vectors[7]['values'], 1, 'ns')['matches'][0]
+    assert match['id'] == '7' and abs(match['score'] - 1) < 1e-5
+
+
+def test_log_is_compacted_into_a_new_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(_Namespace, 'min_compact_bytes', 0)
+    db = NumpyDatabase(str(tmp_path))
+    for i in range(10):
+        db.upsert_many(make_vectors(5, start=5 * i, seed=i), 'ns')
+    db.delete_many(['0', '49'], 'ns')
+
+    store = db._namespaces['ns']
+    assert store.generation > 1
+    # Only the current generation's matrix is kept and the log holds what came after it
+    assert sorted(name for name in os.listdir(store.directory) if name.startswith('vectors')) == \
+        [os.path.basename(store.vectors_path(store.generation))]
+    assert os.path.getsize(store.log_path) <= store._snapshot_bytes
+    assert ids_of(NumpyDatabase(str(tmp_path))) == ids_of(db) == sorted(str(i) for i in range(1, 49))
+
+
+def test_instances_catch_up_on_each_others_writes(tmp_path, monkeypatch):
+    first = NumpyDatabase(str(tmp_path))
+    second = NumpyDatabase(str(tmp_path))
+    first.upsert_many(make_vectors(3), 'ns')
+    assert ids_of(second) == ['0', '1', '2']
+    second.delete_many(['1'], 'ns')
+    second.upsert_many(make_vectors(2, start=3), 'ns')
+    assert ids_of(first) == ['0', '2', '3', '4']
+
+    # A snapshot written by one instance replaces the other's state
+    monkeypatch.setattr(_Namespace, 'min_compact_bytes', 0)
+    first.upsert_many(make_vectors(30, start=5), 'ns')
+    first.delete_many(['0'], 'ns')
+    assert first._namespaces['ns'].generation > second._namespaces['ns'].generation
+    assert ids_of(second) == ids_of(first) == sorted(str(i) for i in range(2, 35))
+
+
+def test_threads_read_while_another_writes(tmp_path):
+    db = NumpyDatabase(str(tmp_path))
+    query = make_vectors(1, seed=1)[0]['values']
+    errors = []
+    done = threading.Event()
+
+    def write():
+        for i in range(100):
+            db.upsert_many(make_vectors(200, seed=i), 'ns')
+            db.delete_many([str(j) for j in range(200)], 'ns')
+        done.set()
+
+    def read():
+        try:
+            while not done.is_set():
+                db.search(query, 50, 'ns')
+                db.fetch_many([str(i) for i in range(200)], 'ns')
+        except Exception as e:
+            errors.append(e)
+            done.set()
+
+    # Switch threads often so reads land in the middle of writes
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
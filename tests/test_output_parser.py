@@ -0,0 +1,30 @@
+import pytest
+from shared_utils.output_parser import StructuredOutputParser, extract_structure, parse_structures
+
+
+def test_finds_structures_in_prose():
+    text = 'Here you go: [\'a\', "b, c", "it\'s"] and {"x": [1, {"y": "}"}], "z": true}. [see below]'
+    assert parse_structures(text) == [['a', 'b, c', "it's"], {'x': [1, {'y': '}'}], 'z': True}]
+    assert parse_structures(text, openers='{') == [{'x': [1, {'y': '}'}], 'z': True}]
+    with pytest.raises(ValueError):
+        extract_structure("Sorry, I don't have a list for that.")
+
+
+def test_repairs_truncated_tail():
+    assert extract_structure("['item 1', 'item 2', 'item thr") == ['item 1', 'item 2']
+    assert extract_structure('{"a": "b", "c": "d') == {'a': 'b'}
+    assert extract_structure('{"files": [{"path": "x", "name": "y"}, {"path": "z"') == \
+        {'files': [{'path': 'x', 'name': 'y'}, {'path': 'z'}]}
+    assert extract_structure("['only item") == ['only item']
+    assert parse_structures("['item 1', 'item 2'", repair=False) == []
+
+
+def test_streamed_pieces_match_whole_text():
+    text = "Sure! ['item 1', 'item \\'2\\'', {'k': [1, 2]}] and ['next'"
+    parser = StructuredOutputParser()
+    found = []
+    for i in range(0, len(text), 3):
+        found.extend(parser.feed(text[i:i + 3]))
+    assert found == [['item 1', "item '2'", {'k': [1, 2]}]]
+    assert parser.close() == [['next']]
+    assert parser.values == parse_structures(text)